@@ -1,45 +1,168 @@
+import time
+MODULE_STARTED = time.perf_counter()
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
-from typing import List
-from docx import Document as WordDoc
-from docx.shared import Inches, Pt
-from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
-from docx.enum.table import WD_ALIGN_VERTICAL
-from docx.oxml import OxmlElement
-from docx.oxml.ns import qn
+from typing import List, Optional
+from collections import Counter
 from io import BytesIO
-import openai
 import os
 import asyncio
 import re
 import json
 from pathlib import Path
+from contextlib import contextmanager, asynccontextmanager
 from fastapi import Request
 from fastapi.responses import JSONResponse
 import datetime
-from bs4 import BeautifulSoup
+import difflib
+import math
+import hashlib
+import heapq
+import itertools
+import sqlite3
+import sys
+import zlib
+import orjson
 from fastapi import APIRouter
-
-app = FastAPI()
-
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# python-docx, BeautifulSoup and openai are imported on first use (see
+# startup_phase) so a cold-started instance can answer before loading them.
+# STARTUP_MODE=eager restores loading everything in the startup hook.
+STARTUP_MODE = os.getenv("STARTUP_MODE", "lazy")
+STARTUP_TIMINGS = {}
+
+@contextmanager
+def startup_phase(name: str):
+    """Time a one-off startup step; only the first run of a phase is recorded."""
+    started = time.perf_counter()
+    yield
+    STARTUP_TIMINGS.setdefault(name, round((time.perf_counter() - started) * 1000, 2))
+
+_openai = None
+
+def openai_api():
+    global _openai
+    if _openai is None:
+        with startup_phase("import openai"):
+            import openai
+            openai.api_key = os.getenv("OPENAI_API_KEY")
+        _openai = openai
+    return _openai
+
+# --- Response encoding ---
+class FastJSONResponse(JSONResponse):
+    """JSON response serialised with orjson.
+
+    Endpoints that build their payload from trusted data return this directly,
+    which also skips FastAPI's jsonable_encoder pass and response validation."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_THREAD_SIZE = 256 * 1024
+COMPRESSIBLE_TYPES = ("application/json", "text/html", "text/plain")
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    return zlib.compress(body, 6, wbits=16 + zlib.MAX_WBITS)
+
+class CompressionMiddleware:
+    """Compress complete JSON/text responses with brotli or gzip.
+
+    Streamed bodies (SSE updates, DOCX exports) pass through untouched: event
+    streams must reach the client as they are produced and DOCX files are
+    already zip archives."""
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                media_type = headers.get("content-type", "").partition(";")[0].strip()
+                if media_type in COMPRESSIBLE_TYPES and "content-encoding" not in headers:
+                    MutableHeaders(scope=message).add_vary_header("Accept-Encoding")
+                    start = message
+                    return
+            elif message["type"] == "http.response.body" and start is not None:
+                body = message.get("body", b"")
+                if not message.get("more_body", False) and len(body) >= self.minimum_size:
+                    if len(body) >= COMPRESSION_THREAD_SIZE:
+                        body = await run_in_threadpool(compress_body, body, encoding)
+                    else:
+                        body = compress_body(body, encoding)
+                    headers = MutableHeaders(scope=start)
+                    headers["Content-Encoding"] = encoding
+                    headers["Content-Length"] = str(len(body))
+                    message = {**message, "body": body}
+                await send(start)
+                start = None
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+app = FastAPI(default_response_class=FastJSONResponse)
+
+app.add_middleware(CompressionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["https://merilmoretolife.github.io"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Section-Sources"],
 )
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
-
 # --- Data Models ---
 class DeviceRequest(BaseModel):
     deviceName: str
     intendedUse: str
     sections: list[str]
+    reuseFinalized: bool = False
+    structured: bool = False
 
 class FinalizedDevice(BaseModel):
     deviceName: str
@@ -55,6 +178,8 @@ class DesignOutputRequest(BaseModel):
     deviceName: str
     intendedUse: str
     section: str
+    deviceId: Optional[str] = None
+    structured: bool = False
 
 class UpdateRequest(BaseModel):
     deviceName: str
@@ -62,9 +187,13 @@ class UpdateRequest(BaseModel):
     section: str
     currentContent: str
     remark: str
+    incremental: bool = False
 
 # --- Helpers ---
 def insert_page_number(paragraph):
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+
     run = paragraph.add_run()
     fldChar1 = OxmlElement('w:fldChar')
     fldChar1.set(qn('w:fldCharType'), 'begin')
@@ -443,122 +572,557 @@ Ensure that appropriate classification and regulatory strategy is mapped based o
     else:
         return f"Generate appropriate Design Output content for section: '{section}' for a device named '{device_name}' with intended use '{intended_use}'."
 
+DI_CONTEXT_CHARS = 6000
+
+def grounded_do_prompt(device_name: str, intended_use: str, section: str, di_excerpt: Optional[str] = None) -> str:
+    prompt = generate_do_prompt(device_name, intended_use, section)
+    if not di_excerpt:
+        return prompt
+    return prompt + f"""
+Finalized Design Input for this section (the Design Output must be consistent with its materials, tests, standards and limits):
+{di_excerpt[:DI_CONTEXT_CHARS]}
+"""
+
+# --- Scheduling ---
+# LLM calls and DOCX rendering go through a PriorityScheduler. Waiting work is
+# served strictly by class priority (interactive, then bulk, then background),
+# each class has its own concurrency cap, and within a class users are served
+# by weighted fair queuing so one user's exports cannot starve another's.
+# Requests are shed with 503 + Retry-After once a class queue is too deep.
+PRIORITY_CLASSES = ("interactive", "bulk", "background")
+USER_WEIGHTS = json.loads(os.getenv("USER_WEIGHTS_JSON", "{}"))
+FAIR_QUEUE_USERS = 1024  # last_finish size that triggers pruning while queues stay busy
+
+class PriorityScheduler:
+    def __init__(self, name: str, capacity: int, limits: dict, queue_limits: dict):
+        self.name = name
+        self.capacity = capacity
+        self.limits = limits
+        self.queue_limits = queue_limits
+        self.running = {cls: 0 for cls in PRIORITY_CLASSES}
+        self.waiting = {cls: 0 for cls in PRIORITY_CLASSES}
+        self.admitted = {cls: 0 for cls in PRIORITY_CLASSES}
+        self.queues = {cls: [] for cls in PRIORITY_CLASSES}
+        self.virtual_time = {cls: 0.0 for cls in PRIORITY_CLASSES}
+        self.last_finish = {}
+        self.service_seconds = {cls: 10.0 for cls in PRIORITY_CLASSES}
+        self.sequence = itertools.count()
+
+    def admit(self, cls: str, count: int = 1):
+        """Refuse new work when the class already has more admitted calls than
+        it can run plus its queue allowance."""
+        depth = self.admitted[cls] + count
+        if depth <= self.limits[cls] + self.queue_limits.get(cls, math.inf):
+            return
+        self._record("scheduler_shed", priority=cls)
+        retry_after = math.ceil(depth * self.service_seconds[cls] / max(1, self.limits[cls]))
+        raise HTTPException(
+            status_code=503,
+            detail=f"Server busy ({cls} queue is full), please retry",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    @contextmanager
+    def admission(self, cls: str, count: int = 1, check: bool = True):
+        """Reserve queue depth for a request's `count` calls while its work runs."""
+        if check:
+            self.admit(cls, count)
+        self.admitted[cls] += count
+        try:
+            yield
+        finally:
+            self.admitted[cls] -= count
+
+    def busy(self, below: str = "background") -> bool:
+        """Whether any work of a higher priority than `below` is running or waiting."""
+        higher = PRIORITY_CLASSES[:PRIORITY_CLASSES.index(below)]
+        return any(self.running[cls] or self.waiting[cls] for cls in higher)
+
+    def snapshot(self) -> dict:
+        return {
+            cls: {
+                "running": self.running[cls],
+                "waiting": self.waiting[cls],
+                "admitted": self.admitted[cls],
+                "limit": self.limits[cls],
+            }
+            for cls in PRIORITY_CLASSES
+        }
+
+    @asynccontextmanager
+    async def slot(self, cls: str, user: str = "anonymous"):
+        # Weighted fair queuing: each grant advances the user's virtual finish
+        # time by 1/weight; the smallest finish time in a class goes first.
+        key = (cls, user)
+        finish = max(self.virtual_time[cls], self.last_finish.get(key, 0.0)) + 1 / USER_WEIGHTS.get(user, 1)
+        self.last_finish[key] = finish
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queues[cls], (finish, next(self.sequence), waiter))
+        self.waiting[cls] += 1
+        queued = time.perf_counter()
+        self._dispatch()
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Granted just as the caller was cancelled: hand the slot back
+                self._release(cls)
+            else:
+                self.waiting[cls] -= 1
+            raise
+
+        started = time.perf_counter()
+        try:
+            self._record("scheduler_wait_ms", (started - queued) * 1000, priority=cls)
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.service_seconds[cls] = 0.8 * self.service_seconds[cls] + 0.2 * elapsed
+            self._release(cls)
+
+    def _record(self, name: str, value: float = 1, **labels):
+        record_metric(name, value, scheduler=self.name, **labels)
+
+    def _release(self, cls: str):
+        self.running[cls] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while sum(self.running.values()) < self.capacity:
+            for cls in PRIORITY_CLASSES:
+                queue = self.queues[cls]
+                while queue and queue[0][2].cancelled():
+                    heapq.heappop(queue)
+                if queue and self.running[cls] < self.limits[cls]:
+                    finish, _, waiter = heapq.heappop(queue)
+                    self.virtual_time[cls] = finish
+                    self.waiting[cls] -= 1
+                    self.running[cls] += 1
+                    waiter.set_result(None)
+                    if not queue or len(self.last_finish) > FAIR_QUEUE_USERS:
+                        self._forget_finished()
+                    break
+            else:
+                return
+
+    def _forget_finished(self):
+        # A user whose last finish time the class has already reached no longer
+        # affects ordering; dropping it keeps X-User rotation from growing this
+        self.last_finish = {
+            key: finish for key, finish in self.last_finish.items() if finish > self.virtual_time[key[0]]
+        }
+
+llm_scheduler = PriorityScheduler(
+    "llm",
+    capacity=int(os.getenv("LLM_CONCURRENCY", "8")),
+    limits={"interactive": 8, "bulk": 6, "background": 1},
+    queue_limits={"interactive": 64, "bulk": 48},
+)
+render_scheduler = PriorityScheduler(
+    "render",
+    capacity=int(os.getenv("RENDER_CONCURRENCY", "2")),
+    limits={"interactive": 2, "bulk": 2, "background": 1},
+    queue_limits={},
+)
+
+def request_user(request: Request) -> str:
+    """Fair-queuing key: the X-User header the frontend sends, else the client address."""
+    return request.headers.get("x-user") or (request.client.host if request.client else "anonymous")
+
+async def run_render(render, user: str):
+    """Build a document in the thread pool, at most RENDER_CONCURRENCY at a time."""
+    async with render_scheduler.slot("bulk", user):
+        return await run_in_threadpool(render)
+
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "0.5"))
+
+async def unless_disconnected(request: Request, work, endpoint: str, on_cancel=None):
+    """Await `work`, cancelling it if the client goes away first.
+
+    Cancelling a gather of completions closes their upstream connections and
+    drops calls still queued in the scheduler; a render already running in the
+    thread pool finishes but its document is discarded. `on_cancel` runs before
+    the request is abandoned, e.g. to cache sections that did complete."""
+    task = asyncio.ensure_future(work)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                break
+        task.cancel()
+        # Let the cancelled calls unwind so every section that completed is recorded
+        await asyncio.wait({task})
+        if not task.cancelled():
+            task.exception()
+    finally:
+        if not task.done():
+            # The handler itself was cancelled; drop the work with it
+            task.cancel()
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    record_metric("requests_cancelled", endpoint=endpoint)
+    if on_cancel is not None:
+        on_cancel()
+    raise HTTPException(status_code=499, detail="Client closed request")
+
+# --- Model routing ---
+# Each LLM call names its task (and section, where it has one). The route picks
+# the model; light tasks start on a cheaper model and escalate to the fallback
+# when the answer fails the route's validator or the prompt is too large for it.
+# Keys may be "task" or "task:section"; MODEL_ROUTES_JSON overrides per key.
+DEFAULT_ROUTE = {"model": "gpt-4o"}
+MODEL_ROUTES = {
+    "extract-options": {"model": "gpt-4o-mini", "fallback": "gpt-4o", "validator": "bullets"},
+    "update-section": {"model": "gpt-4o-mini", "fallback": "gpt-4o", "validator": "tables", "maxPromptChars": 6000},
+    "update-section-patch": {"model": "gpt-4o-mini", "fallback": "gpt-4o", "validator": "json"},
+    "generate-di": {"model": "gpt-4o"},
+    "generate-do": {"model": "gpt-4o"},
+}
+MODEL_ROUTES.update(json.loads(os.getenv("MODEL_ROUTES_JSON", "{}")))
+
+def has_bullets(text: str) -> bool:
+    return any(line.strip().startswith("-") for line in text.split("\n"))
+
+def tables_parse(text: str) -> bool:
+    """Every markdown table has a separator row and the same cell count per row."""
+    block = []
+    for line in text.split("\n") + [""]:
+        if is_table_line(line):
+            block.append(line.strip())
+            continue
+        if block:
+            rows = [row.strip("|").split("|") for row in block]
+            if len(rows) < 2 or not all(re.fullmatch(r"\s*:?-+:?\s*", cell) for cell in rows[1]):
+                return False
+            if any(len(row) != len(rows[0]) for row in rows):
+                return False
+            block = []
+    return True
+
+def is_json_object(text: str) -> bool:
+    try:
+        return isinstance(json.loads(text), dict)
+    except ValueError:
+        return False
+
+RESPONSE_VALIDATORS = {
+    "bullets": has_bullets,
+    "tables": tables_parse,
+    "json": is_json_object,
+}
+
+def model_route(task: str, section: Optional[str] = None) -> dict:
+    if section and f"{task}:{section}" in MODEL_ROUTES:
+        return MODEL_ROUTES[f"{task}:{section}"]
+    return MODEL_ROUTES.get(task, DEFAULT_ROUTE)
+
+def route_models(route: dict, prompt: str) -> list[str]:
+    """Models to try in order for a prompt."""
+    fallback = route.get("fallback")
+    if not fallback or fallback == route["model"]:
+        return [route["model"]]
+    if len(prompt) > route.get("maxPromptChars", math.inf):
+        return [fallback]
+    return [route["model"], fallback]
+
+async def routed_completion(task: str, prompt: str, section: Optional[str] = None,
+                            validate=None, timeout: Optional[float] = None,
+                            priority: str = "interactive", user: str = "anonymous", **params):
+    """Chat completion on the model the task's route selects, escalating to the
+    route's fallback when the cheaper model errors or its answer fails validation.
+    The call waits for an llm_scheduler slot of the given priority first."""
+    async with llm_scheduler.slot(priority, user):
+        return await _routed_completion(task, prompt, section, validate, timeout, **params)
+
+async def _routed_completion(task, prompt, section, validate, timeout, **params):
+    route = model_route(task, section)
+    check = validate or RESPONSE_VALIDATORS.get(route.get("validator"), bool)
+    models = route_models(route, prompt)
+
+    for attempt, model in enumerate(models):
+        last = attempt == len(models) - 1
+        started = time.perf_counter()
+        try:
+            call = openai_api().ChatCompletion.acreate(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                **params
+            )
+            response = await (asyncio.wait_for(call, timeout) if timeout else call)
+        except Exception:
+            record_metric("llm_errors", task=task, model=model)
+            if last:
+                raise
+            record_metric("llm_escalations", task=task, model=model, reason="error")
+            continue
+
+        usage = response.get("usage", {})
+        record_metric("llm_calls", task=task, model=model)
+        record_metric("llm_tokens", usage.get("total_tokens", 0), task=task, model=model)
+        record_metric("llm_latency_ms", (time.perf_counter() - started) * 1000, task=task, model=model)
+        if last or check(response.choices[0].message.content.strip()):
+            return response
+        record_metric("llm_escalations", task=task, model=model, reason="validation")
+
+# --- Structured section output ---
+# With structured=true a section is requested as JSON following this schema,
+# validated and repaired here, and rendered by walking the tree instead of
+# re-parsing free text. Markdown answers are converted to the same tree.
+STRUCTURED_OUTPUT_INSTRUCTIONS = """
+Return the section as a JSON object, with no markdown, following this schema:
+{"subsections": [{"title": "1. Subsection title", "blocks": [
+  {"type": "paragraph", "text": "..."},
+  {"type": "bullets", "items": ["...", "..."]},
+  {"type": "table", "columns": ["Column A", "Column B"], "rows": [["cell", "cell"]]}
+]}]}
+Every table row must have exactly one cell per column. Do not use markdown syntax inside strings.
+"""
+
+def clean_text(value) -> str:
+    if value is None:
+        return ""
+    text = re.sub(r"\*\*|__", "", str(value)).strip()
+    return re.sub(r"^#+\s*", "", text)
+
+def normalize_table(columns, rows):
+    """Table block with separator rows dropped and every row fitted to the
+    column count (surplus cells are folded into the last column)."""
+    rows = [[clean_text(c) for c in row] if isinstance(row, list) else [clean_text(row)] for row in rows or []]
+    rows = [row for row in rows if not all(re.fullmatch(r":?-*:?", cell) for cell in row)]
+    columns = [clean_text(c) for c in columns or []]
+    if not columns and rows:
+        columns = rows.pop(0)
+    if not columns:
+        return None
+
+    width = len(columns)
+    fitted = []
+    for row in rows:
+        if len(row) > width:
+            row = row[:width - 1] + ["; ".join(c for c in row[width - 1:] if c)]
+        fitted.append(row + [""] * (width - len(row)))
+    return {"type": "table", "columns": columns, "rows": fitted}
+
+def normalize_block(block):
+    if isinstance(block, str):
+        text = clean_text(block)
+        return {"type": "paragraph", "text": text} if text else None
+    if not isinstance(block, dict):
+        return None
+    if block.get("type") == "table":
+        return normalize_table(block.get("columns"), block.get("rows"))
+    if block.get("type") == "bullets" or "items" in block:
+        items = [clean_text(item) for item in block.get("items") or []]
+        items = [item for item in items if item]
+        return {"type": "bullets", "items": items} if items else None
+    text = clean_text(block.get("text"))
+    return {"type": "paragraph", "text": text} if text else None
+
+def normalize_section_tree(tree) -> dict:
+    if not isinstance(tree, dict) or not isinstance(tree.get("subsections"), list):
+        raise ValueError("Section JSON has no subsections list")
+    subsections = []
+    for sub in tree["subsections"]:
+        if not isinstance(sub, dict):
+            continue
+        blocks = [b for b in (normalize_block(b) for b in sub.get("blocks") or []) if b]
+        title = clean_text(sub.get("title"))
+        if title or blocks:
+            subsections.append({"title": title, "blocks": blocks})
+    if not subsections:
+        raise ValueError("Section JSON is empty")
+    return {"subsections": subsections}
+
+def is_section_tree(text: str) -> bool:
+    try:
+        normalize_section_tree(json.loads(text))
+        return True
+    except ValueError:
+        return False
+
+def markdown_to_tree(text: str) -> dict:
+    """Best-effort tree for free-text content (reused drafts, or a model that
+    ignored the JSON schema)."""
+    subsections = [{"title": "", "blocks": []}]
+    table = []
+
+    def flush_table():
+        if table:
+            block = normalize_table(None, [row.strip().strip("|").split("|") for row in table])
+            if block:
+                subsections[-1]["blocks"].append(block)
+            table.clear()
+
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if is_table_line(stripped):
+            table.append(stripped)
+            continue
+        flush_table()
+        if not stripped:
+            continue
+        blocks = subsections[-1]["blocks"]
+        bullet = re.match(r"^[-*•]\s+(.+)", stripped)
+        if re.match(r"^#{1,6}\s", stripped) or re.match(r"^(\*\*)?\d+\.\s*(\*\*)?[A-Z]", stripped):
+            subsections.append({"title": clean_text(stripped), "blocks": []})
+        elif bullet:
+            if blocks and blocks[-1]["type"] == "bullets":
+                blocks[-1]["items"].append(clean_text(bullet.group(1)))
+            else:
+                blocks.append({"type": "bullets", "items": [clean_text(bullet.group(1))]})
+        else:
+            blocks.append({"type": "paragraph", "text": clean_text(stripped)})
+    flush_table()
+
+    subsections = [sub for sub in subsections if sub["title"] or sub["blocks"]]
+    return {"subsections": subsections or [{"title": "", "blocks": []}]}
+
+def section_tree_markdown(tree: dict) -> str:
+    parts = []
+    for sub in tree["subsections"]:
+        if sub["title"]:
+            parts.append(f"**{sub['title']}**")
+        for block in sub["blocks"]:
+            if block["type"] == "paragraph":
+                parts.append(block["text"])
+            elif block["type"] == "bullets":
+                parts.append("\n".join(f"- {item}" for item in block["items"]))
+            else:
+                lines = ["| " + " | ".join(block["columns"]) + " |",
+                         "|" + "|".join("---" for _ in block["columns"]) + "|"]
+                lines += ["| " + " | ".join(row) + " |" for row in block["rows"]]
+                parts.append("\n".join(lines))
+    return "\n\n".join(parts)
+
+async def structured_completion(task: str, prompt: str, section: Optional[str] = None,
+                                timeout: Optional[float] = None, **params) -> dict:
+    response = await routed_completion(
+        task, prompt + STRUCTURED_OUTPUT_INSTRUCTIONS, section=section, validate=is_section_tree,
+        timeout=timeout, response_format={"type": "json_object"}, **params
+    )
+    text = response.choices[0].message.content
+    try:
+        return normalize_section_tree(json.loads(text))
+    except ValueError:
+        return markdown_to_tree(text)
+
+def add_docx_table(doc, columns: list[str], rows: list[list[str]]):
+    tbl = doc.add_table(rows=len(rows) + 1, cols=len(columns))
+    tbl.style = "Table Grid"
+    for col_idx, header_text in enumerate(columns):
+        tbl.rows[0].cells[col_idx].text = header_text
+    for row_idx, row_cells in enumerate(rows, start=1):
+        for col_idx, cell_text in enumerate(row_cells):
+            tbl.rows[row_idx].cells[col_idx].text = cell_text
+    # Add a blank line after each table
+    doc.add_paragraph()
+
+def render_section_tree(doc, tree: dict):
+    from docx.shared import Pt
+
+    def add_text(text, bold=False, style=None, space_after=8):
+        para = doc.add_paragraph(style=style)
+        para.paragraph_format.space_after = Pt(space_after)
+        run = para.add_run(text)
+        run.font.name = 'Helvetica'
+        run.font.size = Pt(12)
+        run.bold = bold
+
+    for sub in tree["subsections"]:
+        if sub["title"]:
+            # Add 1 line space before subsection title
+            doc.add_paragraph()
+            add_text(sub["title"], bold=True, space_after=0)
+        for block in sub["blocks"]:
+            if block["type"] == "paragraph":
+                add_text(block["text"])
+            elif block["type"] == "bullets":
+                for item in block["items"]:
+                    add_text(item, style="List Bullet", space_after=2)
+            else:
+                add_docx_table(doc, block["columns"], block["rows"])
+
 # --- /generate Design Input ---
 @app.post("/generate")
-async def generate_response(data: DeviceRequest):
+async def generate_response(data: DeviceRequest, request: Request):
+    user = request_user(request)
+    priority = "interactive" if len(data.sections) <= 1 else "bulk"
     outputs = {}
-    for section in data.sections:
-        prompt = generate_prompt(data.deviceName, data.intendedUse, section)
-        completion = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.5
-        )
-        outputs[section] = completion.choices[0].message.content.strip()
+    sources = {}
+    trees = {}
+    with llm_scheduler.admission(priority, len(data.sections)):
+        for section in data.sections:
+            mode, prompt, source = plan_di_section(data.deviceName, data.intendedUse, section, data.reuseFinalized)
+            sources[section] = plan_source(mode, source)
+            if mode == "reuse":
+                outputs[section] = prompt
+                if data.structured:
+                    trees[section] = markdown_to_tree(prompt)
+                continue
+            if data.structured:
+                trees[section] = await structured_completion(
+                    "generate-di", prompt, section=section, priority=priority, user=user, temperature=0.5
+                )
+                outputs[section] = section_tree_markdown(trees[section])
+                continue
+            completion = await routed_completion(
+                "generate-di", prompt, section=section, priority=priority, user=user, temperature=0.5
+            )
+            outputs[section] = completion.choices[0].message.content.strip()
 
-    return {"results": outputs}
+    if data.structured:
+        return FastJSONResponse({"results": outputs, "structured": trees, "sources": sources})
+    return FastJSONResponse({"results": outputs, "sources": sources})
 
 @app.post("/generate-docx")
-async def generate_word(data: DeviceRequest):
-    doc = WordDoc()
-
-    # Set font globally
-    style = doc.styles['Normal']
-    style.font.name = 'Helvetica'
-    style.font.size = Pt(12)
-
-    section = doc.sections[0]
-
-    # Header
-    header = section.header
-    header_table = header.add_table(rows=1, cols=3, width=Inches(7.5))
-    header_table.autofit = False
-    header_table.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    header_table.columns[0].width = Inches(2)
-    header_table.columns[1].width = Inches(3.5)
-    header_table.columns[2].width = Inches(2)
-
-    # Logo
-    logo_cell = header_table.cell(0, 0)
-    logo_cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
-    logo_para = logo_cell.paragraphs[0]
-    logo_para.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
-    logo_para.add_run().add_picture("meril_logo.jpg", width=Inches(1.1))
-
-    # Title
-    center_cell = header_table.cell(0, 1)
-    center_cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
-    center_para = center_cell.paragraphs[0]
-    center_para.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    run = center_para.add_run("Design Input")
-    run.bold = True
-    run.font.size = Pt(17)
-    run.font.name = 'Helvetica'
-
-    # Doc Number
-    right_cell = header_table.cell(0, 2)
-    right_cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
-    right_para = right_cell.paragraphs[0]
-    right_para.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
-    run = right_para.add_run(f"Document Number: DI/{data.deviceName[:3].upper()}/001\nRev. 00")
-    run.font.size = Pt(11)
-    run.font.name = 'Helvetica'
-
-    # Line under header
-    header_line = header.add_paragraph()
-    header_line_format = header_line.paragraph_format
-    header_line_format.space_before = Pt(2)
-    header_line_format.space_after = Pt(2)
-    hr = header_line.add_run("―" * 54)
-    hr.font.name = 'Helvetica'
-    hr.font.size = Pt(8)
-
-    # Footer
-    footer = section.footer
-    footer_line = footer.add_paragraph()
-    footer_line.add_run("―" * 54).font.size = Pt(8)
-    footer_line.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-
-    footer_paragraph = footer.add_paragraph()
-    footer_paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    run = footer_paragraph.add_run("Meril Healthcare Pvt. Ltd.\nConfidential Document - Page ")
-    run.font.size = Pt(10)
-    run.font.name = 'Helvetica'
-    insert_page_number(footer_paragraph)
-
-    # First page: title (no excessive spacing)
-    doc.add_paragraph()
-    for _ in range(6): doc.add_paragraph()
-    title_para = doc.add_paragraph()
-    title_para.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    run = title_para.add_run(f"Design Input – {data.deviceName}")
-    run.bold = True
-    run.font.size = Pt(23)
-    run.font.name = 'Helvetica'
-
-    # TOC on page 2
-    doc.add_page_break()
-    doc.add_heading("Table of Contents", level=1)
-    numbered_sections = [f"{i+1}. {title}" for i, title in enumerate(data.sections)]
-    for sec in numbered_sections:
-        para = doc.add_paragraph(sec)
-        para.style.font.name = 'Helvetica'
-        para.paragraph_format.space_after = Pt(4)
+async def generate_word(data: DeviceRequest, request: Request):
+    user = request_user(request)
+
+    with startup_phase("import docx"):
+        from docx import Document as WordDoc
+        from docx.shared import Inches, Pt
+        from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+        from docx.enum.table import WD_ALIGN_VERTICAL
+
+    # The exported DI is the content of the device's next revision
+    doc_number, doc_rev = document_number(data.deviceName, next_revision=True)
 
     # Prompts
-    prompts = [(section, generate_prompt(data.deviceName, data.intendedUse, section)) for section in data.sections]
+    plans = [
+        (section, plan_di_section(data.deviceName, data.intendedUse, section, data.reuseFinalized))
+        for section in data.sections
+    ]
 
-    async def fetch(section, prompt):
+    # Sections generated by this request, cached if the client leaves before the export is done
+    completed = []
+
+    def keep_completed():
+        cache_completed("generate-di", completed)
+
+    async def fetch(section, plan):
+        mode, prompt, _ = plan
         try:
-            response = await asyncio.wait_for(
-                openai.ChatCompletion.acreate(
-                    model="gpt-4o",
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.5
-                ),
-                timeout=60
-            )
-            raw = response.choices[0].message.content.strip()
+            if data.structured:
+                if mode == "reuse":
+                    return section, markdown_to_tree(prompt)
+                tree = await structured_completion(
+                    "generate-di", prompt, section=section, timeout=60,
+                    priority="bulk", user=user, temperature=0.5
+                )
+                return section, tree
+            if mode == "reuse":
+                raw = prompt
+            else:
+                raw = claim_cached_completion("generate-di", prompt)
+                if raw is None:
+                    response = await routed_completion(
+                        "generate-di", prompt, section=section, timeout=60,
+                        priority="bulk", user=user, temperature=0.5
+                    )
+                    raw = response.choices[0].message.content.strip()
+                    completed.append((section, prompt, raw, response.get("model", "")))
             cleaned = re.sub(r"[\*\#]+", "", raw)
             cleaned = re.sub(r"\n(?=\d+\.)", "\n", cleaned)
 
@@ -573,47 +1137,148 @@ async def generate_word(data: DeviceRequest):
                     formatted.append(("normal", line))
             return section, formatted
         except Exception as e:
+            if data.structured:
+                return section, markdown_to_tree(f"⚠️ Error generating section: {str(e)}")
             return section, [("normal", f"⚠️ Error generating section: {str(e)}")]
 
-    results = await asyncio.gather(*[fetch(s, p) for s, p in prompts])
+    with llm_scheduler.admission("bulk", len(data.sections)):
+        results = await unless_disconnected(
+            request, asyncio.gather(*[fetch(s, p) for s, p in plans]), "generate-docx", keep_completed
+        )
 
-    # Section content
-    for i, (section, lines) in enumerate(results):
-        doc.add_page_break()
+    def render_document():
+        doc = WordDoc()
+
+        # Set font globally
+        style = doc.styles['Normal']
+        style.font.name = 'Helvetica'
+        style.font.size = Pt(12)
+
+        section = doc.sections[0]
+
+        # Header
+        header = section.header
+        header_table = header.add_table(rows=1, cols=3, width=Inches(7.5))
+        header_table.autofit = False
+        header_table.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+        header_table.columns[0].width = Inches(2)
+        header_table.columns[1].width = Inches(3.5)
+        header_table.columns[2].width = Inches(2)
+
+        # Logo
+        logo_cell = header_table.cell(0, 0)
+        logo_cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
+        logo_para = logo_cell.paragraphs[0]
+        logo_para.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
+        logo_para.add_run().add_picture("meril_logo.jpg", width=Inches(1.1))
+
+        # Title
+        center_cell = header_table.cell(0, 1)
+        center_cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
+        center_para = center_cell.paragraphs[0]
+        center_para.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+        run = center_para.add_run("Design Input")
+        run.bold = True
+        run.font.size = Pt(17)
+        run.font.name = 'Helvetica'
+
+        # Doc Number
+        right_cell = header_table.cell(0, 2)
+        right_cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
+        right_para = right_cell.paragraphs[0]
+        right_para.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+        run = right_para.add_run(f"Document Number: DI/{doc_number}\nRev. {doc_rev:02d}")
+        run.font.size = Pt(11)
+        run.font.name = 'Helvetica'
 
-        heading = doc.add_paragraph()
-        heading.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
-        run = heading.add_run(f"{i+1}. {section}")
+        # Line under header
+        header_line = header.add_paragraph()
+        header_line_format = header_line.paragraph_format
+        header_line_format.space_before = Pt(2)
+        header_line_format.space_after = Pt(2)
+        hr = header_line.add_run("―" * 54)
+        hr.font.name = 'Helvetica'
+        hr.font.size = Pt(8)
+
+        # Footer
+        footer = section.footer
+        footer_line = footer.add_paragraph()
+        footer_line.add_run("―" * 54).font.size = Pt(8)
+        footer_line.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+
+        footer_paragraph = footer.add_paragraph()
+        footer_paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+        run = footer_paragraph.add_run("Meril Healthcare Pvt. Ltd.\nConfidential Document - Page ")
+        run.font.size = Pt(10)
+        run.font.name = 'Helvetica'
+        insert_page_number(footer_paragraph)
+
+        # First page: title (no excessive spacing)
+        doc.add_paragraph()
+        for _ in range(6): doc.add_paragraph()
+        title_para = doc.add_paragraph()
+        title_para.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+        run = title_para.add_run(f"Design Input – {data.deviceName}")
         run.bold = True
-        run.font.size = Pt(15)
+        run.font.size = Pt(23)
         run.font.name = 'Helvetica'
 
-        for tag, line in lines:
-            if not line.strip():
-                continue
-            if tag == "bold":
-                # Add 1 line space before subsection title
-                doc.add_paragraph()
-
-            para = doc.add_paragraph()
-            para.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
-            para.paragraph_format.space_after = Pt(0 if tag == "bold" else 8)
-            run = para.add_run(line.strip())
+        # TOC on page 2
+        doc.add_page_break()
+        doc.add_heading("Table of Contents", level=1)
+        numbered_sections = [f"{i+1}. {title}" for i, title in enumerate(data.sections)]
+        for sec in numbered_sections:
+            para = doc.add_paragraph(sec)
+            para.style.font.name = 'Helvetica'
+            para.paragraph_format.space_after = Pt(4)
+
+        # Section content
+        for i, (section, lines) in enumerate(results):
+            doc.add_page_break()
+
+            heading = doc.add_paragraph()
+            heading.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
+            run = heading.add_run(f"{i+1}. {section}")
+            run.bold = True
+            run.font.size = Pt(15)
             run.font.name = 'Helvetica'
-            run.font.size = Pt(12)
-            if tag == "bold":
-                run.bold = True
 
-    # Save file
-    file_stream = BytesIO()
-    doc.save(file_stream)
-    file_stream.seek(0)
+            if data.structured:
+                render_section_tree(doc, lines)
+                continue
+
+            for tag, line in lines:
+                if not line.strip():
+                    continue
+                if tag == "bold":
+                    # Add 1 line space before subsection title
+                    doc.add_paragraph()
+
+                para = doc.add_paragraph()
+                para.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
+                para.paragraph_format.space_after = Pt(0 if tag == "bold" else 8)
+                run = para.add_run(line.strip())
+                run.font.name = 'Helvetica'
+                run.font.size = Pt(12)
+                if tag == "bold":
+                    run.bold = True
+
+        # Save file
+        file_stream = BytesIO()
+        doc.save(file_stream)
+        file_stream.seek(0)
+        return file_stream
 
+    file_stream = await unless_disconnected(
+        request, run_render(render_document, user), "generate-docx", keep_completed
+    )
     return StreamingResponse(
         file_stream,
         media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
         headers={
-            "Content-Disposition": f"attachment; filename=Design_Input_{data.deviceName.replace(' ', '_')}.docx"
+            "Content-Disposition": f"attachment; filename=Design_Input_{data.deviceName.replace(' ', '_')}.docx",
+            # Where each section came from (see plan_source), as on /generate
+            "X-Section-Sources": json.dumps({section: plan_source(mode, source) for section, (mode, _, source) in plans}),
         }
     )
 
@@ -622,112 +1287,54 @@ class DOExportRequest(BaseModel):
     intendedUse: str
     sections: list[str]
     results: dict
+    deviceId: Optional[str] = None
+    structured: bool = False
 
 @app.post("/generate-do-docx")
-async def generate_do_word(data: DOExportRequest):
+async def generate_do_word(data: DOExportRequest, request: Request):
     from io import BytesIO
 
-    # Create document and set global font
-    doc = WordDoc()
-    style = doc.styles['Normal']
-    style.font.name = 'Helvetica'
-    style.font.size = Pt(12)
-
-    section = doc.sections[0]
-
-    # --- Header ---
-    header = section.header
-    header_table = header.add_table(rows=1, cols=3, width=Inches(7.5))
-    header_table.autofit = False
-    header_table.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    header_table.columns[0].width = Inches(2)
-    header_table.columns[1].width = Inches(3.5)
-    header_table.columns[2].width = Inches(2)
-
-    # Logo cell
-    logo_cell = header_table.cell(0, 0)
-    logo_cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
-    logo_para = logo_cell.paragraphs[0]
-    logo_para.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
-    logo_para.add_run().add_picture("meril_logo.jpg", width=Inches(1.1))
-
-    # Title cell
-    center_cell = header_table.cell(0, 1)
-    center_cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
-    center_para = center_cell.paragraphs[0]
-    center_para.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    run = center_para.add_run("Design Output")
-    run.bold = True
-    run.font.size = Pt(17)
-    run.font.name = 'Helvetica'
-
-    # Document number cell
-    right_cell = header_table.cell(0, 2)
-    right_cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
-    right_para = right_cell.paragraphs[0]
-    right_para.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
-    run = right_para.add_run(f"Document Number: DO/{data.deviceName[:3].upper()}/001\nRev. 00")
-    run.font.size = Pt(11)
-    run.font.name = 'Helvetica'
-
-    # Horizontal rule under header
-    header_line = header.add_paragraph()
-    header_line_format = header_line.paragraph_format
-    header_line_format.space_before = Pt(2)
-    header_line_format.space_after = Pt(2)
-    hr = header_line.add_run("―" * 54)
-    hr.font.name = 'Helvetica'
-    hr.font.size = Pt(8)
-
-    # --- Footer ---
-    footer = section.footer
-    footer_line = footer.add_paragraph()
-    footer_line.add_run("―" * 54).font.size = Pt(8)
-    footer_line.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-
-    footer_paragraph = footer.add_paragraph()
-    footer_paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    run = footer_paragraph.add_run("Meril Healthcare Pvt. Ltd.\nConfidential Document - Page ")
-    run.font.size = Pt(10)
-    run.font.name = 'Helvetica'
-    insert_page_number(footer_paragraph)
-
-    # --- Title Page ---
-    doc.add_paragraph()
-    for _ in range(6):
-        doc.add_paragraph()
-    title_para = doc.add_paragraph()
-    title_para.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    run = title_para.add_run(f"Design Output – {data.deviceName}")
-    run.bold = True
-    run.font.size = Pt(23)
-    run.font.name = 'Helvetica'
-
-    # --- Table of Contents ---
-    doc.add_page_break()
-    doc.add_heading("Table of Contents", level=1)
-    for i, section_title in enumerate(data.sections):
-        para = doc.add_paragraph(f"{i+1}. {section_title}")
-        para.paragraph_format.space_after = Pt(4)
-        para.style.font.name = 'Helvetica'
+    user = request_user(request)
+
+    with startup_phase("import docx"):
+        from docx import Document as WordDoc
+        from docx.shared import Inches, Pt
+        from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+        from docx.enum.table import WD_ALIGN_VERTICAL
 
     # --- Fetch AI content ---
+    di_record = find_finalized_record(data.deviceId, data.deviceName)
+    # The DO follows the finalized DI it was grounded on
+    doc_number, doc_rev = document_number(
+        di_record.deviceName if di_record else data.deviceName, next_revision=False
+    )
     prompts = [
-        (section, generate_do_prompt(data.deviceName, data.intendedUse, section))
+        (section, grounded_do_prompt(data.deviceName, data.intendedUse, section, di_section_excerpt(di_record, section)))
         for section in data.sections
     ]
 
+    # Sections generated by this request, cached if the client leaves before the export is done
+    completed = []
+
+    def keep_completed():
+        cache_completed("generate-do", completed, di_record.id if di_record else None)
+
     async def fetch(section, prompt):
         try:
-            response = await asyncio.wait_for(
-                openai.ChatCompletion.acreate(
-                    model="gpt-4o",
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.5
-                ),
-                timeout=60
-            )
-            raw = response.choices[0].message.content.strip()
+            if data.structured:
+                tree = await structured_completion(
+                    "generate-do", prompt, section=section, timeout=60,
+                    priority="bulk", user=user, temperature=0.5
+                )
+                return section, tree
+            raw = claim_cached_completion("generate-do", prompt)
+            if raw is None:
+                response = await routed_completion(
+                    "generate-do", prompt, section=section, timeout=60,
+                    priority="bulk", user=user, temperature=0.5
+                )
+                raw = response.choices[0].message.content.strip()
+                completed.append((section, prompt, raw, response.get("model", "")))
             cleaned = re.sub(r"[#\*]+", "", raw)
             lines = cleaned.split("\n")
             formatted = []
@@ -738,82 +1345,163 @@ async def generate_do_word(data: DOExportRequest):
                     formatted.append(("normal", line))
             return section, formatted
         except Exception as e:
+            if data.structured:
+                return section, markdown_to_tree(f"⚠️ Error: {str(e)}")
             return section, [("normal", f"⚠️ Error: {str(e)}")]
 
-    results = await asyncio.gather(*[fetch(s, p) for s, p in prompts])
+    with llm_scheduler.admission("bulk", len(data.sections)):
+        results = await unless_disconnected(
+            request, asyncio.gather(*[fetch(s, p) for s, p in prompts]), "generate-do-docx", keep_completed
+        )
 
-    # --- Insert sections with real tables and spacing fixes ---
-    for i, (section_title, formatted_lines) in enumerate(results):
-        doc.add_page_break()
-        heading = doc.add_paragraph()
-        heading.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
-        run = heading.add_run(f"{i+1}. {section_title}")
+    def render_document():
+        # Create document and set global font
+        doc = WordDoc()
+        style = doc.styles['Normal']
+        style.font.name = 'Helvetica'
+        style.font.size = Pt(12)
+
+        section = doc.sections[0]
+
+        # --- Header ---
+        header = section.header
+        header_table = header.add_table(rows=1, cols=3, width=Inches(7.5))
+        header_table.autofit = False
+        header_table.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+        header_table.columns[0].width = Inches(2)
+        header_table.columns[1].width = Inches(3.5)
+        header_table.columns[2].width = Inches(2)
+
+        # Logo cell
+        logo_cell = header_table.cell(0, 0)
+        logo_cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
+        logo_para = logo_cell.paragraphs[0]
+        logo_para.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
+        logo_para.add_run().add_picture("meril_logo.jpg", width=Inches(1.1))
+
+        # Title cell
+        center_cell = header_table.cell(0, 1)
+        center_cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
+        center_para = center_cell.paragraphs[0]
+        center_para.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+        run = center_para.add_run("Design Output")
         run.bold = True
-        run.font.size = Pt(15)
+        run.font.size = Pt(17)
         run.font.name = 'Helvetica'
 
-        idx = 0
-        while idx < len(formatted_lines):
-            tag, content = formatted_lines[idx]
-
-            # Table detection: lines starting and ending with "|"
-            if content.strip().startswith("|") and content.strip().endswith("|"):
-                # Gather the full markdown table block
-                table_block = []
-                while (
-                    idx < len(formatted_lines)
-                    and formatted_lines[idx][1].strip().startswith("|")
-                    and formatted_lines[idx][1].strip().endswith("|")
-                ):
-                    table_block.append(formatted_lines[idx][1].strip())
-                    idx += 1
-
-                # Parse rows and skip the separator row of hyphens
-                raw_rows = [row.strip("|").split("|") for row in table_block]
-                header_cells = raw_rows[0]
-                data_rows = [
-                    row for row in raw_rows[1:]
-                    if not all(re.fullmatch(r"-+", cell.strip()) for cell in row)
-                ]
-                rows = [header_cells] + data_rows
-
-                # Create a real docx table
-                tbl = doc.add_table(rows=len(rows), cols=len(rows[0]))
-                tbl.style = "Table Grid"
-
-                # Fill header row
-                for col_idx, header_text in enumerate(rows[0]):
-                    tbl.rows[0].cells[col_idx].text = header_text.strip()
-
-                # Fill data rows
-                for row_idx, row_cells in enumerate(rows[1:], start=1):
-                    for col_idx, cell_text in enumerate(row_cells):
-                        tbl.rows[row_idx].cells[col_idx].text = cell_text.strip()
-
-                # Add a blank line after each table
-                doc.add_paragraph()
-                continue  # skip the normal paragraph logic
-
-            # Normal paragraph logic
-            if content.strip():
-                # Add a blank line before each subsection title
-                if tag == "bold":
-                    doc.add_paragraph()
+        # Document number cell
+        right_cell = header_table.cell(0, 2)
+        right_cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
+        right_para = right_cell.paragraphs[0]
+        right_para.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+        run = right_para.add_run(f"Document Number: DO/{doc_number}\nRev. {doc_rev:02d}")
+        run.font.size = Pt(11)
+        run.font.name = 'Helvetica'
 
-                para = doc.add_paragraph()
-                para.paragraph_format.space_after = Pt(0 if tag == "bold" else 8)
-                run = para.add_run(content)
-                run.font.name = 'Helvetica'
-                run.font.size = Pt(12)
-                if tag == "bold":
-                    run.bold = True
+        # Horizontal rule under header
+        header_line = header.add_paragraph()
+        header_line_format = header_line.paragraph_format
+        header_line_format.space_before = Pt(2)
+        header_line_format.space_after = Pt(2)
+        hr = header_line.add_run("―" * 54)
+        hr.font.name = 'Helvetica'
+        hr.font.size = Pt(8)
+
+        # --- Footer ---
+        footer = section.footer
+        footer_line = footer.add_paragraph()
+        footer_line.add_run("―" * 54).font.size = Pt(8)
+        footer_line.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+
+        footer_paragraph = footer.add_paragraph()
+        footer_paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+        run = footer_paragraph.add_run("Meril Healthcare Pvt. Ltd.\nConfidential Document - Page ")
+        run.font.size = Pt(10)
+        run.font.name = 'Helvetica'
+        insert_page_number(footer_paragraph)
+
+        # --- Title Page ---
+        doc.add_paragraph()
+        for _ in range(6):
+            doc.add_paragraph()
+        title_para = doc.add_paragraph()
+        title_para.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+        run = title_para.add_run(f"Design Output – {data.deviceName}")
+        run.bold = True
+        run.font.size = Pt(23)
+        run.font.name = 'Helvetica'
+
+        # --- Table of Contents ---
+        doc.add_page_break()
+        doc.add_heading("Table of Contents", level=1)
+        for i, section_title in enumerate(data.sections):
+            para = doc.add_paragraph(f"{i+1}. {section_title}")
+            para.paragraph_format.space_after = Pt(4)
+            para.style.font.name = 'Helvetica'
+
+        # --- Insert sections with real tables and spacing fixes ---
+        for i, (section_title, formatted_lines) in enumerate(results):
+            doc.add_page_break()
+            heading = doc.add_paragraph()
+            heading.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
+            run = heading.add_run(f"{i+1}. {section_title}")
+            run.bold = True
+            run.font.size = Pt(15)
+            run.font.name = 'Helvetica'
 
-            idx += 1
+            if data.structured:
+                render_section_tree(doc, formatted_lines)
+                continue
 
-    # --- Save and return the .docx ---
-    file_stream = BytesIO()
-    doc.save(file_stream)
-    file_stream.seek(0)
+            idx = 0
+            while idx < len(formatted_lines):
+                tag, content = formatted_lines[idx]
+
+                # Table detection: lines starting and ending with "|"
+                if content.strip().startswith("|") and content.strip().endswith("|"):
+                    # Gather the full markdown table block
+                    table_block = []
+                    while (
+                        idx < len(formatted_lines)
+                        and formatted_lines[idx][1].strip().startswith("|")
+                        and formatted_lines[idx][1].strip().endswith("|")
+                    ):
+                        table_block.append(formatted_lines[idx][1].strip())
+                        idx += 1
+
+                    # Parse rows, skip the separator row of hyphens and fit
+                    # every row to the header so python-docx never overflows
+                    raw_rows = [row.strip("|").split("|") for row in table_block]
+                    table = normalize_table(raw_rows[0], raw_rows[1:])
+                    if table:
+                        add_docx_table(doc, table["columns"], table["rows"])
+                    continue  # skip the normal paragraph logic
+
+                # Normal paragraph logic
+                if content.strip():
+                    # Add a blank line before each subsection title
+                    if tag == "bold":
+                        doc.add_paragraph()
+
+                    para = doc.add_paragraph()
+                    para.paragraph_format.space_after = Pt(0 if tag == "bold" else 8)
+                    run = para.add_run(content)
+                    run.font.name = 'Helvetica'
+                    run.font.size = Pt(12)
+                    if tag == "bold":
+                        run.bold = True
+
+                idx += 1
+
+        # --- Save and return the .docx ---
+        file_stream = BytesIO()
+        doc.save(file_stream)
+        file_stream.seek(0)
+        return file_stream
+
+    file_stream = await unless_disconnected(
+        request, run_render(render_document, user), "generate-do-docx", keep_completed
+    )
     return StreamingResponse(
         file_stream,
         media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
@@ -824,28 +1512,327 @@ async def generate_do_word(data: DOExportRequest):
 
 # --- /generate-do (Design Output) ---
 @app.post("/generate-do")
-async def generate_design_output(data: DesignOutputRequest):
-    prompt = generate_do_prompt(data.deviceName, data.intendedUse, data.section)
+async def generate_design_output(data: DesignOutputRequest, request: Request):
+    user = request_user(request)
+    di_record = find_finalized_record(data.deviceId, data.deviceName)
+    di_excerpt = di_section_excerpt(di_record, data.section)
+    prompt = grounded_do_prompt(data.deviceName, data.intendedUse, data.section, di_excerpt)
+    with llm_scheduler.admission("interactive"):
+        try:
+            if data.structured:
+                tree = await structured_completion(
+                    "generate-do", prompt, section=data.section, user=user, temperature=0.4
+                )
+                return {
+                    "result": section_tree_markdown(tree),
+                    "structured": tree,
+                    "groundedOn": di_record.id if di_excerpt else None,
+                }
+            cached = claim_cached_completion("generate-do", prompt)
+            if cached is not None:
+                return {
+                    "result": cached,
+                    "groundedOn": di_record.id if di_excerpt else None,
+                    "pregenerated": True,
+                }
+            response = await routed_completion("generate-do", prompt, section=data.section, user=user, temperature=0.4)
+            return {
+                "result": response.choices[0].message.content.strip(),
+                "groundedOn": di_record.id if di_excerpt else None,
+            }
+        except Exception as e:
+            return {"error": str(e)}
+
+# --- Design Input HTML helpers ---
+# Knowledge base linking standards to their meanings
+STANDARD_MEANINGS = {
+    # Sterilization
+    "ISO 11135": "Ethylene Oxide Sterilization",
+    "ISO 11137": "Gamma Radiation Sterilization",
+    "AAMI TIR28": "EO Sterilization Validation",
+    "ISO 17665": "Steam Sterilization",
+    # Biocompatibility
+    "ISO 10993-5": "Cytotoxicity Testing",
+    "ISO 10993-10": "Skin Sensitization Testing",
+    "ISO 10993-23": "Irritation Testing",
+    "USP <87>": "In Vitro Cytotoxicity",
+    "USP <88>": "In Vivo Biocompatibility",
+    # Packaging
+    "ISO 11607": "Packaging Validation",
+    "ASTM D4169": "Distribution Simulation Testing",
+    # Labeling
+    "EN ISO 15223-1": "Medical Device Symbols",
+    "21 CFR Part 801": "US Labeling Requirements",
+    # Quality Systems
+    "ISO 13485": "Quality Management System",
+    "21 CFR Part 820": "US FDA QSR"
+}
+
+def find_section_text(soup, section: str):
+    """Plain text of one section of the Design Input HTML built by the frontend,
+    or None when the section block cannot be located."""
+    normalized = section.replace(" ", "").replace("/", "").replace("-", "")
+
+    section_div = soup.find("div", {"id": f"section-block-{normalized}"})
+    if not section_div:
+        header = soup.find(["h2", "h3"], string=lambda text: section.lower() in text.lower() if text else False)
+        section_div = header.find_parent("div") if header else None
+
+    if not section_div:
+        return None
+    content_div = section_div.find("div", {"id": f"result-{normalized}"}) or \
+                 section_div.find("div", class_=lambda x: x and "results" in x.lower()) or \
+                 section_div
+    return html_block_text(content_div)
+
+BLOCK_TAGS = ["p", "li", "h1", "h2", "h3", "h4", "h5", "h6", "pre", "blockquote", "div"]
+
+def html_block_text(element) -> str:
+    """Text of an HTML fragment with one line per block element and tables kept
+    as markdown pipe rows, so it reads like the generated section it came from.
+    Modifies the element in place."""
+    for table in element.find_all("table"):
+        rows = []
+        for tr in table.find_all("tr"):
+            cells = [cell.get_text(" ", strip=True) for cell in tr.find_all(["th", "td"])]
+            rows.append("| " + " | ".join(cells) + " |")
+            if len(rows) == 1:
+                rows.append("|" + "|".join("---" for _ in cells) + "|")
+        table.replace_with("\n" + "\n".join(rows) + "\n")
+    for br in element.find_all("br"):
+        br.replace_with("\n")
+    for block in element.find_all(BLOCK_TAGS):
+        if block.name == "li":
+            block.insert(0, "- ")
+        block.insert_before("\n")
+        block.append("\n")
+
+    lines = [re.sub(r"[ \t\xa0]+", " ", line).strip() for line in element.get_text().split("\n")]
+    return "\n".join(line for line in lines if line)
+
+# --- Shared store for finalized DI entries ---
+# One SQLite database (WAL mode) holds the archive and its search index, so any
+# number of uvicorn workers can read and write it. Every write bumps
+# store_meta.version inside the same transaction; workers compare it against
+# the version their in-memory caches were built from and reload when it moved.
+STORE_FILE = Path(os.getenv("STORE_FILE", "finalized_store.db"))
+DATA_FILE = Path("finalized_data.json")  # legacy archive, imported once
+INDEX_VERSION = 2
+_store_conn = None
+_archive_cache = {"version": None, "seq": 0, "by_id": {}, "records": []}
+
+def store():
+    global _store_conn
+    if _store_conn is None:
+        with startup_phase("open store"):
+            conn = open_store()
+        with startup_phase("prepare archive"):
+            prepare_archive(conn)
+        _store_conn = conn
+    return _store_conn
+
+def open_store():
+    conn = sqlite3.connect(STORE_FILE, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA busy_timeout = 30000")
+    with store_transaction(conn):
+        if conn.execute("PRAGMA user_version").fetchone()[0] < INDEX_VERSION:
+            # Text extraction changed: drop the index and let sync_search_index rebuild it
+            conn.execute("DROP TABLE IF EXISTS indexed_records")
+            conn.execute("DROP TABLE IF EXISTS section_text")
+            conn.execute("DROP TABLE IF EXISTS section_bodies")
+            conn.execute("DROP TABLE IF EXISTS section_standards")
+            conn.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+        for statement in STORE_SCHEMA:
+            conn.execute(statement)
+    return conn
+
+STORE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS store_meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )""",
+    "INSERT OR IGNORE INTO store_meta VALUES ('version', 0)",
+    """CREATE TABLE IF NOT EXISTS finalized_devices (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        record_id TEXT UNIQUE NOT NULL,
+        record TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS devices (
+        device_id TEXT PRIMARY KEY,
+        device_name TEXT NOT NULL,
+        doc_prefix TEXT NOT NULL,
+        doc_seq INTEGER NOT NULL,
+        latest_rev INTEGER NOT NULL,
+        UNIQUE (doc_prefix, doc_seq)
+    )""",
+    """CREATE TABLE IF NOT EXISTS revisions (
+        device_id TEXT NOT NULL,
+        rev INTEGER NOT NULL,
+        revision_id TEXT UNIQUE NOT NULL,
+        kind TEXT NOT NULL,
+        meta TEXT NOT NULL,
+        body BLOB NOT NULL,
+        PRIMARY KEY (device_id, rev)
+    )""",
+    """CREATE TABLE IF NOT EXISTS indexed_records (
+        record_id TEXT PRIMARY KEY,
+        device_name TEXT,
+        intended_use TEXT,
+        finalized_at TEXT
+    )""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS section_text USING fts5(
+        record_id UNINDEXED, section, device_name, intended_use, body,
+        tokenize = 'porter unicode61'
+    )""",
+    # Same split as section_text, keyed for direct lookups (FTS5 can only scan)
+    """CREATE TABLE IF NOT EXISTS section_bodies (
+        record_id TEXT NOT NULL,
+        section TEXT NOT NULL,
+        body TEXT NOT NULL,
+        PRIMARY KEY (record_id, section)
+    )""",
+    """CREATE TABLE IF NOT EXISTS section_standards (
+        record_id TEXT,
+        section TEXT,
+        standard TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_section_standards ON section_standards (standard, record_id)",
+    """CREATE TABLE IF NOT EXISTS completion_cache (
+        key TEXT PRIMARY KEY,
+        task TEXT NOT NULL,
+        record_id TEXT,
+        section TEXT,
+        content TEXT NOT NULL,
+        model TEXT,
+        created_at REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS metrics (
+        name TEXT NOT NULL,
+        labels TEXT NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY (name, labels)
+    )""",
+]
+
+@contextmanager
+def store_transaction(conn=None):
+    """Write transaction; BEGIN IMMEDIATE takes the write lock up front so
+    concurrent workers queue on busy_timeout instead of failing mid-way."""
+    conn = conn or store()
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        response = await openai.ChatCompletion.acreate(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.4,
-        )
-        return {"result": response.choices[0].message.content.strip()}
-    except Exception as e:
-        return {"error": str(e)}
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def bump_store_version(conn):
+    conn.execute("UPDATE store_meta SET value = value + 1 WHERE key = 'version'")
+
+def store_version() -> int:
+    return store().execute("SELECT value FROM store_meta WHERE key = 'version'").fetchone()[0]
+
+HTML_COMPRESSION_LEVEL = 6
+
+class FinalizedRecord:
+    """Compact, read-only view of a finalized DI kept in each worker's cache.
+    Metadata lives in slots and the HTML body is stored zlib-compressed, only
+    inflated when designInputHtml is read."""
+    __slots__ = (
+        "id", "seq", "deviceName", "intendedUse", "finalizedBy", "diComplete",
+        "doComplete", "finalizedAt", "sections", "revision", "documentNumber", "_html",
+    )
 
-# In-memory storage for finalized DI entries
-finalized_devices_db = []
-DATA_FILE = Path("finalized_data.json")
+    def __init__(self, seq: int, rid: str, record: dict):
+        self.id = rid
+        self.seq = seq
+        self.deviceName = record.get("deviceName", "")
+        self.intendedUse = record.get("intendedUse", "")
+        self.finalizedBy = sys.intern(record.get("finalizedBy", ""))
+        self.diComplete = bool(record.get("diComplete"))
+        self.doComplete = bool(record.get("doComplete"))
+        self.finalizedAt = record.get("finalizedAt", "")
+        self.sections = tuple(sys.intern(s) for s in record.get("sections", []))
+        self.revision = record.get("revision", 0)
+        self.documentNumber = record.get("documentNumber")
+        self._html = zlib.compress(record.get("designInputHtml", "").encode("utf-8"), HTML_COMPRESSION_LEVEL)
+
+    @property
+    def designInputHtml(self) -> str:
+        return zlib.decompress(self._html).decode("utf-8")
+
+    def to_dict(self) -> dict:
+        return {
+            "deviceName": self.deviceName,
+            "intendedUse": self.intendedUse,
+            "designInputHtml": self.designInputHtml,
+            "finalizedBy": self.finalizedBy,
+            "diComplete": self.diComplete,
+            "doComplete": self.doComplete,
+            "finalizedAt": self.finalizedAt,
+            "sections": list(self.sections),
+            "id": self.id,
+            "revision": self.revision,
+            "documentNumber": self.documentNumber,
+        }
+
+def finalized_records() -> list:
+    """Finalized records, newest first, from this worker's cache of the store.
+    When the store version moves only rows written since the last refresh are
+    decoded; a full reload happens only if rows disappeared."""
+    version = store_version()
+    if _archive_cache["version"] != version:
+        conn = store()
+        by_id = _archive_cache["by_id"]
+        rows = conn.execute(
+            "SELECT seq, record_id, record FROM finalized_devices WHERE seq > ? ORDER BY seq",
+            (_archive_cache["seq"],),
+        ).fetchall()
+        for seq, rid, record in rows:
+            by_id[rid] = FinalizedRecord(seq, rid, json.loads(record))
+            _archive_cache["seq"] = seq
+
+        if len(by_id) != conn.execute("SELECT COUNT(*) FROM finalized_devices").fetchone()[0]:
+            _archive_cache.update(version=None, seq=0, by_id={}, records=[])
+            return finalized_records()
+
+        _archive_cache["records"] = sorted(by_id.values(), key=lambda r: r.seq, reverse=True)
+        _archive_cache["version"] = version
+    return _archive_cache["records"]
+
+def prepare_archive(conn):
+    """Import the legacy JSON archive into an empty store, convert stores written
+    before revisions existed and bring the search index up to date. Runs on first
+    use of the store rather than at startup."""
+    with store_transaction(conn):
+        # Only the first worker to get the write lock imports or migrates
+        if conn.execute("SELECT value FROM store_meta WHERE key = 'schema'").fetchone() is None:
+            migrate_to_revisions(conn)
+            conn.execute("INSERT INTO store_meta VALUES ('schema', ?)", (REVISION_SCHEMA_VERSION,))
+            bump_store_version(conn)
+        empty = conn.execute("SELECT COUNT(*) FROM finalized_devices").fetchone()[0] == 0
+        if empty and DATA_FILE.exists():
+            with open(DATA_FILE, "r") as f:
+                legacy = json.load(f)
+            # The file is newest first; revisions are added oldest first
+            for record in reversed(legacy):
+                add_revision(conn, record)
+            bump_store_version(conn)
+    sync_search_index(conn)
 
 @app.on_event("startup")
 async def load_finalized_data():
-    global finalized_devices_db
-    if DATA_FILE.exists():
-        with open(DATA_FILE, "r") as f:
-            finalized_devices_db = json.load(f)
+    STARTUP_TIMINGS.setdefault("import app", round((APP_IMPORTED - MODULE_STARTED) * 1000, 2))
+    if STARTUP_MODE == "eager":
+        openai_api()
+        with startup_phase("import docx"):
+            import docx
+        with startup_phase("import bs4"):
+            import bs4
+        store()
 
 class FinalizedDevice(BaseModel):
     deviceName: str
@@ -856,26 +1843,649 @@ class FinalizedDevice(BaseModel):
     doComplete: bool
     finalizedAt: str
     sections: list[str] 
+    id: Optional[str] = None
+    revision: Optional[int] = None
+    documentNumber: Optional[str] = None
 
 
 @app.post("/finalize-di")
-async def save_finalized_di(data: FinalizedDevice):
+async def save_finalized_di(data: FinalizedDevice, pregenerateDo: bool = False):
     record = data.dict()
-    finalized_devices_db.insert(0, record)
+    for key in ("id", "revision", "documentNumber"):
+        record.pop(key, None)
+
+    # Diff against the latest revision off the event loop and outside the
+    # write transaction; add_revision falls back to a snapshot if it went stale
+    precomputed = None
+    latest = find_finalized_record(device_slug(record["deviceName"]))
+    if latest is not None:
+        delta = await run_in_threadpool(revision_delta, latest.designInputHtml, record["designInputHtml"])
+        precomputed = (latest.revision, delta)
+
+    bodies = await run_in_threadpool(section_bodies_for, record)
+
+    with store_transaction() as conn:
+        head, added = add_revision(conn, record, precomputed)
+        if added:
+            index_record(head, bodies, conn)
+            bump_store_version(conn)
+
+    # A retried finalize adds no revision and must not pay for the drafts again
+    if pregenerateDo and added:
+        enqueue_do_pregeneration(head["deviceId"], head["sections"])
+
+    return {
+        "message": "Saved successfully",
+        "id": head["deviceId"],
+        "revision": head["revision"],
+        "documentNumber": head["documentNumber"],
+    }
+
+# Records come straight from the store, so they are serialised as-is; the
+# response_model only documents the shape.
+@app.get("/finalized-devices", response_model=List[FinalizedDevice])
+async def get_finalized_devices():
+    return FastJSONResponse([record.to_dict() for record in finalized_records()])
+
+# --- Revisions ---
+# Every finalize of a device adds a revision. The device is identified by a slug
+# of its name and gets a document number (first three letters of the name plus
+# a per-prefix sequence) the first time it is finalized. finalized_devices holds
+# the full latest revision of each device; the revisions table holds the
+# history, each revision a delta against the one before it and every
+# REVISION_SNAPSHOT_INTERVAL-th revision a full snapshot, so rebuilding any
+# revision replays at most that many deltas.
+REVISION_SCHEMA_VERSION = 2
+REVISION_SNAPSHOT_INTERVAL = int(os.getenv("REVISION_SNAPSHOT_INTERVAL", "10"))
+REVISION_DIFF_MAX_BLOCKS = 4000
+REVISION_DIFF_MIN_RATIO = 0.5
+
+def device_slug(device_name: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", device_name.lower()).strip("-") or "device"
+
+def document_prefix(device_name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]", "", device_name)[:3].upper() or "DEV"
+
+def next_document_seq(conn, prefix: str) -> int:
+    row = conn.execute("SELECT MAX(doc_seq) FROM devices WHERE doc_prefix = ?", (prefix,)).fetchone()
+    return (row[0] or 0) + 1
+
+BLOCK_END = re.compile(r".*?(?:</(?:p|li|tr|h[1-6]|div|table|ul|ol|pre|blockquote)>|\n)|.+", re.S | re.I)
+
+def html_tokens(html: str) -> list[str]:
+    # Split after every closing block tag and newline: the frontend's HTML is
+    # often one line, and whole blocks repeat far less than single tags do
+    return BLOCK_END.findall(html)
+
+def encode_delta(old: str, new: str) -> Optional[list]:
+    """Ops rebuilding `new` from `old`: [start, end] copies a run of old blocks,
+    a string inserts new text. None when the documents are too large or too
+    different for a delta to pay off, so the caller stores a snapshot."""
+    old_tokens, new_tokens = html_tokens(old), html_tokens(new)
+    if max(len(old_tokens), len(new_tokens)) > REVISION_DIFF_MAX_BLOCKS:
+        return None
+    matcher = difflib.SequenceMatcher(None, old_tokens, new_tokens, autojunk=False)
+    if matcher.real_quick_ratio() < REVISION_DIFF_MIN_RATIO or matcher.quick_ratio() < REVISION_DIFF_MIN_RATIO:
+        return None
+    ops = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append("".join(new_tokens[j1:j2]))
+    return ops
+
+def apply_delta(old: str, ops: list) -> str:
+    old_tokens = html_tokens(old)
+    return "".join(op if isinstance(op, str) else "".join(old_tokens[op[0]:op[1]]) for op in ops)
+
+def revision_delta(old: str, new: str) -> Optional[str]:
+    """Serialised delta from `old` to `new`, or None when a snapshot is smaller
+    or the diff is not worth computing."""
+    ops = encode_delta(old, new)
+    if ops is None:
+        return None
+    delta = json.dumps(ops)
+    return delta if len(delta) < len(new) else None
+
+def revision_id(record: dict) -> str:
+    """Id of one finalize of a device. These were the record ids before revisions
+    existed, so ids held by older clients still resolve."""
+    key = f"{record.get('deviceName', '')}|{record.get('finalizedAt', '')}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+def reserve_device(conn, device_name: str) -> tuple:
+    """(prefix, sequence, latest revision) of a device, giving it the next
+    document number for its prefix the first time it is seen. The latest
+    revision is -1 until the device is finalized. Must run inside a
+    store_transaction."""
+    device_id = device_slug(device_name)
+    device = conn.execute(
+        "SELECT doc_prefix, doc_seq, latest_rev FROM devices WHERE device_id = ?", (device_id,)
+    ).fetchone()
+    if device is not None:
+        return device
+    prefix = document_prefix(device_name)
+    seq = next_document_seq(conn, prefix)
+    conn.execute("INSERT INTO devices VALUES (?, ?, ?, ?, -1)", (device_id, device_name, prefix, seq))
+    return prefix, seq, -1
+
+def add_revision(conn, record: dict, precomputed: Optional[tuple] = None) -> tuple:
+    """Store `record` as the next revision of its device and make it the
+    device's latest record; must run inside a store_transaction. Returns the
+    stored latest record and whether a revision was added: finalizing the same
+    record twice adds nothing.
+
+    `precomputed` is (base revision, revision_delta result) worked out before
+    the transaction, so the write lock is not held while diffing; if another
+    revision landed in between, a snapshot is stored instead."""
+    device_id = device_slug(record.get("deviceName", ""))
+    rev_id = revision_id(record)
+    if conn.execute("SELECT 1 FROM revisions WHERE revision_id = ?", (rev_id,)).fetchone():
+        return json.loads(conn.execute(
+            "SELECT record FROM finalized_devices WHERE record_id = ?", (device_id,)
+        ).fetchone()[0]), False
+
+    prefix, seq, latest = reserve_device(conn, record.get("deviceName", ""))
+    rev = latest + 1
+    conn.execute(
+        "UPDATE devices SET device_name = ?, latest_rev = ? WHERE device_id = ?",
+        (record.get("deviceName", ""), rev, device_id),
+    )
 
-    # Save to file
-    with open(DATA_FILE, "w") as f:
-        json.dump(finalized_devices_db, f, indent=2)
+    html = record.get("designInputHtml", "")
+    kind, body = "snapshot", html
+    previous = conn.execute(
+        "SELECT record FROM finalized_devices WHERE record_id = ?", (device_id,)
+    ).fetchone()
+    if previous is not None and rev % REVISION_SNAPSHOT_INTERVAL:
+        if precomputed is None:
+            delta = revision_delta(json.loads(previous[0]).get("designInputHtml", ""), html)
+        else:
+            delta = precomputed[1] if precomputed[0] == rev - 1 else None
+        if delta is not None:
+            kind, body = "delta", delta
+
+    head = dict(record, deviceId=device_id, revision=rev, revisionId=rev_id,
+                documentNumber=f"{prefix}/{seq:03d}")
+    meta = {key: value for key, value in head.items() if key != "designInputHtml"}
+    conn.execute(
+        "INSERT INTO revisions VALUES (?, ?, ?, ?, ?, ?)",
+        (device_id, rev, rev_id, kind, json.dumps(meta),
+         zlib.compress(body.encode("utf-8"), HTML_COMPRESSION_LEVEL)),
+    )
+    # Replacing the row gives it a new seq, so workers pick it up incrementally
+    conn.execute("DELETE FROM finalized_devices WHERE record_id = ?", (device_id,))
+    conn.execute(
+        "INSERT INTO finalized_devices (record_id, record) VALUES (?, ?)", (device_id, json.dumps(head))
+    )
+    return head, True
+
+def revision_record(device_id: str, rev: int) -> Optional[dict]:
+    """Full record of one revision: the nearest snapshot at or below it plus
+    the deltas after that snapshot."""
+    conn = store()
+    meta = conn.execute(
+        "SELECT meta FROM revisions WHERE device_id = ? AND rev = ?", (device_id, rev)
+    ).fetchone()
+    if meta is None:
+        return None
+    rows = conn.execute(
+        """SELECT kind, body FROM revisions WHERE device_id = ? AND rev <= ? AND rev >= (
+               SELECT MAX(rev) FROM revisions WHERE device_id = ? AND rev <= ? AND kind = 'snapshot'
+           ) ORDER BY rev""",
+        (device_id, rev, device_id, rev),
+    ).fetchall()
+    html = ""
+    for kind, body in rows:
+        body = zlib.decompress(body).decode("utf-8")
+        html = body if kind == "snapshot" else apply_delta(html, json.loads(body))
+    return dict(json.loads(meta[0]), designInputHtml=html)
+
+def migrate_to_revisions(conn):
+    """Turn the one-row-per-finalize archive into revisions, oldest first, so
+    repeated finalizes of a device become its revision history."""
+    rows = conn.execute("SELECT record_id, record FROM finalized_devices ORDER BY seq").fetchall()
+    conn.execute("DELETE FROM finalized_devices")
+    for old_id, record in rows:
+        head, _ = add_revision(conn, json.loads(record))
+        # Pre-generated drafts were keyed by the old record id
+        conn.execute(
+            "UPDATE completion_cache SET record_id = ? WHERE record_id = ?", (head["deviceId"], old_id)
+        )
 
-    return {"message": "Saved successfully"}
+def document_number(device_name: str, next_revision: bool) -> tuple:
+    """Document number and revision for a device's DOCX headers. The number is
+    reserved the first time a device is exported, so a DI exported before it is
+    finalized keeps the number it will be finalized under. With next_revision
+    the revision is the one the exported content becomes when finalized;
+    otherwise it is the latest finalized revision."""
+    device = store().execute(
+        "SELECT doc_prefix, doc_seq, latest_rev FROM devices WHERE device_id = ?", (device_slug(device_name),)
+    ).fetchone()
+    if device is None:
+        with store_transaction() as conn:
+            device = reserve_device(conn, device_name)
+    prefix, seq, latest = device
+    return f"{prefix}/{seq:03d}", latest + 1 if next_revision else max(latest, 0)
+
+@app.get("/finalized-devices/{device_id}/revisions")
+async def list_revisions(device_id: str):
+    rows = store().execute(
+        "SELECT kind, meta FROM revisions WHERE device_id = ? ORDER BY rev DESC", (device_id,)
+    ).fetchall()
+    if not rows:
+        raise HTTPException(status_code=404, detail="Device not found")
+    revisions = []
+    for kind, meta in rows:
+        meta = json.loads(meta)
+        revisions.append({
+            "revision": meta["revision"],
+            "revisionId": meta["revisionId"],
+            "documentNumber": meta["documentNumber"],
+            "finalizedBy": meta.get("finalizedBy", ""),
+            "finalizedAt": meta.get("finalizedAt", ""),
+            "stored": kind,
+        })
+    return {"deviceId": device_id, "revisions": revisions}
+
+@app.get("/finalized-devices/{device_id}/revisions/{revision}", response_model=FinalizedDevice)
+async def get_revision(device_id: str, revision: int):
+    record = revision_record(device_id, revision)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Revision not found")
+    record["id"] = record.pop("deviceId")
+    return FastJSONResponse(record)
+
+# --- Completion cache ---
+# Completions produced ahead of time (see pregenerate_worker) keyed by task and
+# exact prompt. Entries are single-use: the first matching request takes the
+# entry, so a later "regenerate" still gets a fresh completion.
+COMPLETION_CACHE_TTL = float(os.getenv("COMPLETION_CACHE_TTL_HOURS", "168")) * 3600
+
+def completion_key(task: str, prompt: str) -> str:
+    return hashlib.sha256(f"{task}\n{prompt}".encode("utf-8")).hexdigest()
+
+def cache_completion(task: str, prompt: str, content: str, model: str,
+                     rid: Optional[str] = None, section: Optional[str] = None):
+    store().execute(
+        "INSERT OR REPLACE INTO completion_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (completion_key(task, prompt), task, rid, section, content, model, time.time()),
+    )
 
-@app.get("/finalized-devices")
-async def get_finalized_devices() -> List[FinalizedDevice]:
-    return finalized_devices_db
+def cache_completed(task: str, completed: list, rid: Optional[str] = None):
+    """Cache (section, prompt, content, model) completions of an abandoned request."""
+    for section, prompt, content, model in completed:
+        cache_completion(task, prompt, content, model, rid, section)
+
+def claim_cached_completion(task: str, prompt: str) -> Optional[str]:
+    key = completion_key(task, prompt)
+    with store_transaction() as conn:
+        row = conn.execute("SELECT content, created_at FROM completion_cache WHERE key = ?", (key,)).fetchone()
+        if row:
+            conn.execute("DELETE FROM completion_cache WHERE key = ?", (key,))
+    if row and time.time() - row[1] <= COMPLETION_CACHE_TTL:
+        record_metric("completion_cache_hits", task=task)
+        return row[0]
+    return None
+
+# --- Speculative Design Output pre-generation ---
+# /finalize-di?pregenerateDo=true queues every DO section of the device. One
+# background task per worker works through the queue at PREGEN_RPM and only
+# while the LLM scheduler has no interactive or bulk work, then leaves the
+# result in the completion cache for /generate-do and /generate-do-docx.
+PREGEN_RPM = float(os.getenv("PREGEN_RPM", "6"))
+_pregen_queue = None
+_pregen_worker = None
+
+def enqueue_do_pregeneration(rid: str, sections: list[str]):
+    global _pregen_queue, _pregen_worker
+    if _pregen_queue is None:
+        _pregen_queue = asyncio.Queue()
+    if _pregen_worker is None or _pregen_worker.done():
+        _pregen_worker = asyncio.create_task(pregenerate_worker())
+    for section in sections:
+        _pregen_queue.put_nowait((rid, section))
+
+async def pregenerate_worker():
+    while True:
+        rid, section = await _pregen_queue.get()
+        while llm_scheduler.busy():
+            await asyncio.sleep(1)
+
+        record = find_finalized_record(rid)
+        if record is None:
+            continue
+        prompt = grounded_do_prompt(
+            record.deviceName, record.intendedUse, section, di_section_excerpt(record, section)
+        )
+        try:
+            response = await routed_completion(
+                "generate-do", prompt, section=section, priority="background", timeout=120, temperature=0.4
+            )
+            cache_completion(
+                "generate-do", prompt, response.choices[0].message.content.strip(),
+                response.get("model", ""), rid, section,
+            )
+            record_metric("pregenerated_sections")
+        except Exception as e:
+            print(f"Pre-generation failed for {section}: {str(e)}")
+        await asyncio.sleep(60 / PREGEN_RPM)
+
+@app.get("/finalized-devices/{device_id}/do-drafts")
+async def get_do_drafts(device_id: str):
+    """Sections whose Design Output has been pre-generated and not yet used."""
+    rows = store().execute(
+        "SELECT section, model, created_at FROM completion_cache WHERE record_id = ? AND created_at > ?",
+        (device_id, time.time() - COMPLETION_CACHE_TTL),
+    ).fetchall()
+    return {"drafts": [
+        {"section": section, "model": model,
+         "createdAt": datetime.datetime.fromtimestamp(created_at, datetime.timezone.utc).isoformat()}
+        for section, model, created_at in rows
+    ]}
+
+# --- Search index over finalized devices ---
+# Full-text (FTS5) rows per DI section plus a table of the STANDARD_MEANINGS
+# standards each section cites. HTML is stripped once, when a DI is finalized,
+# in the same transaction that stores the record.
+STANDARD_PATTERNS = {
+    std: re.compile(r"(?<![\w])" + r"\s*".join(map(re.escape, std.split())) + r"(?![\d])", re.IGNORECASE)
+    for std in STANDARD_MEANINGS
+}
+
+def record_id(record: dict) -> str:
+    """Id of a finalized record: the device id shared by all its revisions."""
+    return record.get("deviceId") or device_slug(record.get("deviceName", ""))
+
+def cited_standards(text: str) -> list[str]:
+    return [std for std, pattern in STANDARD_PATTERNS.items() if pattern.search(text)]
+
+SYNC_BATCH_SIZE = 20
+
+def section_bodies_for(record: dict) -> dict:
+    """Plain text of each section of a record's Design Input HTML. Parsing a
+    large DI takes a while, so callers run this before taking the write lock."""
+    with startup_phase("import bs4"):
+        from bs4 import BeautifulSoup
+    soup = BeautifulSoup(record.get("designInputHtml", ""), "html.parser")
+
+    bodies = {}
+    for section in record.get("sections", []):
+        text = find_section_text(soup, section)
+        if text:
+            bodies[section] = text
+    if not bodies:
+        # Unknown layout: index the document as a single block
+        bodies[""] = html_block_text(soup)
+    return bodies
+
+def index_record(record: dict, bodies: dict, conn):
+    """Index one record from its section_bodies_for() split; must run inside a
+    store_transaction."""
+    rid = record_id(record)
+    conn.execute("DELETE FROM section_text WHERE record_id = ?", (rid,))
+    conn.execute("DELETE FROM section_bodies WHERE record_id = ?", (rid,))
+    conn.execute("DELETE FROM section_standards WHERE record_id = ?", (rid,))
+    conn.execute(
+        "INSERT OR REPLACE INTO indexed_records VALUES (?, ?, ?, ?)",
+        (rid, record.get("deviceName", ""), record.get("intendedUse", ""), record.get("finalizedAt", "")),
+    )
+    for section, text in bodies.items():
+        conn.execute(
+            "INSERT INTO section_text VALUES (?, ?, ?, ?, ?)",
+            (rid, section, record.get("deviceName", ""), record.get("intendedUse", ""), text),
+        )
+        conn.execute("INSERT INTO section_bodies VALUES (?, ?, ?)", (rid, section, text))
+        conn.executemany(
+            "INSERT INTO section_standards VALUES (?, ?, ?)",
+            [(rid, section, std) for std in cited_standards(text)],
+        )
 
-@app.post("/update-section")
-async def update_section(data: UpdateRequest):
-    prompt = f"""Revise the following Design Input content for the medical device '{data.deviceName}', intended for '{data.intendedUse}', under the section '{data.section}'.
+def sync_search_index(conn):
+    """Index records missing from the index and drop entries for removed ones.
+    Only ids are compared, so a store that is already in sync costs two scans.
+    Records are parsed outside the write lock and written SYNC_BATCH_SIZE at a
+    time, so a full rebuild never holds the lock for long."""
+    wanted = {row[0] for row in conn.execute("SELECT record_id FROM finalized_devices")}
+    indexed = {row[0] for row in conn.execute("SELECT record_id FROM indexed_records")}
+    if wanted == indexed:
+        return
+
+    if indexed - wanted:
+        with store_transaction(conn):
+            for rid in indexed - wanted:
+                for table in ("indexed_records", "section_text", "section_bodies", "section_standards"):
+                    conn.execute(f"DELETE FROM {table} WHERE record_id = ?", (rid,))
+            bump_store_version(conn)
+
+    missing = sorted(wanted - indexed)
+    for start in range(0, len(missing), SYNC_BATCH_SIZE):
+        batch = missing[start:start + SYNC_BATCH_SIZE]
+        rows = conn.execute(
+            f"SELECT record_id, record FROM finalized_devices WHERE record_id IN ({','.join('?' * len(batch))})",
+            batch,
+        ).fetchall()
+        parsed = [(rid, raw, section_bodies_for(json.loads(raw))) for rid, raw in rows]
+        with store_transaction(conn):
+            for rid, raw, bodies in parsed:
+                current = conn.execute("SELECT record FROM finalized_devices WHERE record_id = ?", (rid,)).fetchone()
+                # Skip records another worker replaced (and indexed) meanwhile
+                if current is not None and current[0] == raw:
+                    index_record(json.loads(raw), bodies, conn)
+            bump_store_version(conn)
+
+def find_finalized_record(device_id: Optional[str], device_name: str = ""):
+    """Latest revision of a finalized device by device id (or the id of any of its
+    revisions), falling back to the device with the same name."""
+    if device_id:
+        row = store().execute("SELECT device_id FROM revisions WHERE revision_id = ?", (device_id,)).fetchone()
+        if row:
+            device_id = row[0]
+        for record in finalized_records():
+            if record.id == device_id:
+                return record
+    name = device_name.strip().lower()
+    if name:
+        for record in finalized_records():
+            if record.deviceName.strip().lower() == name:
+                return record
+    return None
+
+def di_section_excerpt(record: Optional[FinalizedRecord], section: str) -> Optional[str]:
+    """Text of one DI section from the per-section split stored at index time."""
+    if record is None:
+        return None
+    row = store().execute(
+        "SELECT body FROM section_bodies WHERE record_id = ? AND section = ?", (record.id, section)
+    ).fetchone()
+    return row[0] if row else None
+
+def fts_query(text: str) -> str:
+    # Quote every term so user input can never be parsed as FTS5 syntax
+    terms = re.findall(r"\w+", text)
+    return " ".join(f'"{t}"' for t in terms)
+
+@app.get("/search")
+async def search_devices(q: str = "", standard: str = "", section: str = "", limit: int = 20):
+    started = time.perf_counter()
+    conn = store()
+    limit = max(1, min(limit, 100))
+
+    where, params = [], []
+    if q.strip():
+        where.append("section_text MATCH ?")
+        params.append(fts_query(q))
+    if section:
+        where.append("section_text.section = ?")
+        params.append(section)
+    if standard:
+        std = next((k for k, v in STANDARD_MEANINGS.items()
+                    if standard.lower() in (k.lower(), v.lower())), standard)
+        where.append("""EXISTS (SELECT 1 FROM section_standards s
+                        WHERE s.record_id = section_text.record_id
+                        AND s.section = section_text.section AND s.standard = ?)""")
+        params.append(std)
+    if not where:
+        return {"results": [], "tookMs": 0}
+
+    rank = "bm25(section_text)" if q.strip() else "0"
+    rows = conn.execute(
+        f"""SELECT section_text.record_id, section_text.section,
+                   snippet(section_text, 4, '[', ']', '…', 12), {rank} AS score
+            FROM section_text WHERE {' AND '.join(where)}
+            ORDER BY score LIMIT ?""",
+        (*params, limit * 5),
+    ).fetchall()
+
+    results = {}
+    for rid, sec, snippet, score in rows:
+        hit = results.get(rid)
+        if hit is None:
+            if len(results) >= limit:
+                continue
+            meta = conn.execute(
+                "SELECT device_name, intended_use, finalized_at FROM indexed_records WHERE record_id = ?", (rid,)
+            ).fetchone()
+            standards = [r[0] for r in conn.execute(
+                "SELECT DISTINCT standard FROM section_standards WHERE record_id = ? ORDER BY standard", (rid,)
+            )]
+            hit = results[rid] = {
+                "id": rid,
+                "deviceName": meta[0],
+                "intendedUse": meta[1],
+                "finalizedAt": meta[2],
+                "standards": [{"standard": s, "meaning": STANDARD_MEANINGS.get(s, "")} for s in standards],
+                "matches": [],
+            }
+        hit["matches"].append({"section": sec, "snippet": snippet})
+
+    return {
+        "results": list(results.values()),
+        "tookMs": round((time.perf_counter() - started) * 1000, 2),
+    }
+
+@app.get("/search/standards")
+async def search_standards():
+    rows = store().execute(
+        "SELECT standard, COUNT(DISTINCT record_id) FROM section_standards GROUP BY standard ORDER BY 2 DESC"
+    ).fetchall()
+    return {"standards": [
+        {"standard": std, "meaning": STANDARD_MEANINGS.get(std, ""), "devices": count} for std, count in rows
+    ]}
+
+# --- Retrieval-seeded generation ---
+# Requests that set reuseFinalized have the requested device compared to the
+# finalized ones by TF-IDF cosine over device name and intended use. Near-identical devices reuse the approved
+# section as-is; similar ones get it as context with a short "adapt" prompt.
+RETRIEVAL_REUSE_THRESHOLD = float(os.getenv("RETRIEVAL_REUSE_THRESHOLD", "0.9"))
+RETRIEVAL_ADAPT_THRESHOLD = float(os.getenv("RETRIEVAL_ADAPT_THRESHOLD", "0.35"))
+RETRIEVAL_CONTEXT_CHARS = 6000
+
+DESCRIPTOR_STOPWORDS = {
+    "a", "an", "the", "and", "or", "of", "to", "in", "on", "for", "with", "by", "as", "at",
+    "is", "are", "be", "used", "use", "during", "device", "medical",
+}
+_similarity_index = None
+
+def descriptor_terms(device_name: str, intended_use: str) -> Counter:
+    terms = Counter()
+    for weight, text in ((2, device_name), (1, intended_use)):
+        for word in re.findall(r"[a-z0-9]+", text.lower()):
+            if word in DESCRIPTOR_STOPWORDS or len(word) < 2:
+                continue
+            if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+                word = word[:-1]
+            terms[word] += weight
+    return terms
+
+def tfidf_vector(terms: Counter, idf: dict, default_idf: float) -> dict:
+    vector = {t: tf * idf.get(t, default_idf) for t, tf in terms.items()}
+    norm = math.sqrt(sum(w * w for w in vector.values())) or 1.0
+    return {t: w / norm for t, w in vector.items()}
+
+def similarity_index() -> dict:
+    global _similarity_index
+    version = store_version()
+    if _similarity_index is None or _similarity_index["version"] != version:
+        rows = store().execute(
+            "SELECT record_id, device_name, intended_use, finalized_at FROM indexed_records"
+        ).fetchall()
+        docs = [(row, descriptor_terms(row[1], row[2])) for row in rows]
+        df = Counter()
+        for _, terms in docs:
+            df.update(terms.keys())
+        n = len(docs)
+        idf = {t: math.log((1 + n) / (1 + c)) + 1 for t, c in df.items()}
+        default_idf = math.log(1 + n) + 1
+        _similarity_index = {
+            "version": version,
+            "idf": idf,
+            "default_idf": default_idf,
+            "docs": [(row, tfidf_vector(terms, idf, default_idf)) for row, terms in docs],
+        }
+    return _similarity_index
+
+def retrieve_similar_section(device_name: str, intended_use: str, section: str):
+    """Most similar finalized device that has approved content for the section,
+    or None when nothing clears RETRIEVAL_ADAPT_THRESHOLD."""
+    index = similarity_index()
+    if not index["docs"]:
+        return None
+    query = tfidf_vector(descriptor_terms(device_name, intended_use), index["idf"], index["default_idf"])
+
+    scored = []
+    for (rid, name, use, finalized_at), vector in index["docs"]:
+        score = sum(w * vector.get(t, 0.0) for t, w in query.items())
+        if score >= RETRIEVAL_ADAPT_THRESHOLD:
+            scored.append((score, finalized_at, rid, name, use))
+
+    conn = store()
+    for score, _, rid, name, use in sorted(scored, reverse=True):
+        row = conn.execute(
+            "SELECT body FROM section_bodies WHERE record_id = ? AND section = ?", (rid, section)
+        ).fetchone()
+        if row and row[0].strip():
+            return {
+                "id": rid,
+                "deviceName": name,
+                "intendedUse": use,
+                "similarity": round(score, 3),
+                "content": row[0],
+            }
+    return None
+
+def adapt_prompt(device_name: str, intended_use: str, section: str, source: dict) -> str:
+    return f"""Adapt the approved Design Input below, written for the medical device '{source['deviceName']}' (intended for '{source['intendedUse']}'), to the medical device '{device_name}', intended for '{intended_use}', under the section: '{section}'.
+
+Keep the structure, standards and wording wherever they still apply and change only what differs for the new device. Return only the adapted section content.
+
+Approved Content:
+{source['content'][:RETRIEVAL_CONTEXT_CHARS]}
+"""
+
+def plan_di_section(device_name: str, intended_use: str, section: str, reuse: bool = False):
+    """How a Design Input section is produced: ("reuse", content, source),
+    ("adapt", prompt, source) or ("generate", prompt, None)."""
+    source = retrieve_similar_section(device_name, intended_use, section) if reuse else None
+    if source is None:
+        return "generate", generate_prompt(device_name, intended_use, section), None
+    if source["similarity"] >= RETRIEVAL_REUSE_THRESHOLD:
+        return "reuse", source["content"], source
+    return "adapt", adapt_prompt(device_name, intended_use, section, source), source
+
+def plan_source(mode: str, source):
+    if source is None:
+        return {"mode": mode}
+    return {
+        "mode": mode,
+        "deviceName": source["deviceName"],
+        "finalizedId": source["id"],
+        "similarity": source["similarity"],
+    }
+
+def update_prompt(data: UpdateRequest) -> str:
+    return f"""Revise the following Design Input content for the medical device '{data.deviceName}', intended for '{data.intendedUse}', under the section '{data.section}'.
 
 Only make precise updates based on the user remark provided below. Do not rewrite the entire section. Only modify or remove the specific sentence or subsection as per the remark. Maintain the original structure.
 
@@ -885,50 +2495,241 @@ User Remark:
 Current Section Content:
 {data.currentContent}
 """
+
+@app.post("/update-section")
+async def update_section(data: UpdateRequest, request: Request):
+    user = request_user(request)
+    with llm_scheduler.admission("interactive"):
+        if data.incremental:
+            return await update_section_incremental(data, user)
+
+        prompt = update_prompt(data)
+
+        try:
+            response = await routed_completion("update-section", prompt, section=data.section, user=user, temperature=0.3)
+            return {"result": response.choices[0].message.content.strip()}
+        except Exception as e:
+            return {"error": str(e)}
+
+def sse_event(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+@app.post("/update-section/stream")
+async def update_section_stream(data: UpdateRequest, request: Request):
+    user = request_user(request)
+    llm_scheduler.admit("interactive")
+    prompt = update_prompt(data)
+
+    async def event_stream():
+        stream = None
+        parts = []
+        usage = {}
+        with llm_scheduler.admission("interactive", check=False):
+            async with llm_scheduler.slot("interactive", user):
+                try:
+                    # Streamed text cannot be validated before it reaches the client,
+                    # so the stream goes straight to the route's final model choice
+                    model = route_models(model_route("update-section", data.section), prompt)[-1]
+                    record_metric("llm_calls", task="update-section-stream", model=model)
+                    stream = await openai_api().ChatCompletion.acreate(
+                        model=model,
+                        messages=[{"role": "user", "content": prompt}],
+                        temperature=0.3,
+                        stream=True,
+                        stream_options={"include_usage": True},
+                    )
+                    async for chunk in stream:
+                        if await request.is_disconnected():
+                            # Client went away: stop reading so the upstream call is torn down
+                            break
+                        if chunk.get("usage"):
+                            usage = chunk["usage"]
+                        if not chunk.get("choices"):
+                            continue
+                        token = chunk.choices[0].get("delta", {}).get("content")
+                        if token:
+                            parts.append(token)
+                            yield sse_event("delta", {"content": token})
+                    else:
+                        record_metric("llm_tokens", usage.get("total_tokens", 0), task="update-section-stream", model=model)
+                        yield sse_event("done", {"result": "".join(parts).strip(), "usage": usage})
+                except Exception as e:
+                    yield sse_event("error", {"error": str(e)})
+                finally:
+                    # Closing the upstream generator releases the HTTP connection,
+                    # which aborts generation (and billing) on the OpenAI side.
+                    if stream is not None:
+                        await stream.aclose()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- Incremental section updates ---
+# Lines around each remark hit (and the header row of any table it falls in) are
+# the only part of the section sent upstream; the model answers with a patch.
+PATCH_CONTEXT_LINES = 2
+PATCH_MAX_WINDOW_RATIO = 0.6
+
+REMARK_STOPWORDS = {
+    "a", "an", "the", "and", "or", "of", "to", "in", "on", "for", "with", "by", "as", "at",
+    "is", "are", "be", "it", "this", "that", "these", "those", "from", "please", "should",
+    "add", "remove", "delete", "change", "update", "replace", "include", "mention", "also",
+    "instead", "section", "line", "row", "table", "point", "make", "use", "not", "no",
+}
+
+def remark_terms(text: str) -> set:
+    words = re.findall(r"[a-z0-9<>]+(?:[-./][a-z0-9<>]+)*", text.lower())
+    return {w for w in words if w not in REMARK_STOPWORDS and len(w) > 1}
+
+def is_table_line(line: str) -> bool:
+    stripped = line.strip()
+    return stripped.startswith("|") and stripped.endswith("|")
+
+def select_patch_window(lines: list[str], remark: str):
+    """Return the sorted line indexes the remark most likely targets, or None
+    when the remark cannot be localised and the whole section must be sent."""
+    terms = remark_terms(remark)
+    if not terms or not lines:
+        return None
+
+    scores = [len(terms & remark_terms(line)) for line in lines]
+    best = max(scores)
+    if best == 0:
+        return None
+
+    window = set()
+    for idx, score in enumerate(scores):
+        if score * 2 < best:
+            continue
+        lo = max(0, idx - PATCH_CONTEXT_LINES)
+        hi = min(len(lines), idx + PATCH_CONTEXT_LINES + 1)
+        window.update(range(lo, hi))
+        if is_table_line(lines[idx]):
+            # Keep the table header so the model sees the column layout
+            start = idx
+            while start > 0 and is_table_line(lines[start - 1]):
+                start -= 1
+            window.add(start)
+
+    window = {i for i in window if lines[i].strip()}
+    if len(window) > PATCH_MAX_WINDOW_RATIO * sum(1 for l in lines if l.strip()):
+        return None
+    return sorted(window)
+
+def apply_section_patch(lines: list[str], ops: list, allowed: set) -> list[str]:
+    """Apply replace/insert_after/delete operations addressed by "L<n>" anchors.
+    Raises ValueError on anything outside the window that was sent."""
+    replaced, inserted, deleted = {}, {}, set()
+    for op in ops:
+        kind = op.get("op")
+        anchor = str(op.get("anchor", ""))
+        match = re.fullmatch(r"L(\d+)", anchor.strip())
+        if not match or int(match.group(1)) not in allowed:
+            raise ValueError(f"Invalid patch anchor: {anchor!r}")
+        idx = int(match.group(1))
+        new_lines = op.get("lines") or []
+        if isinstance(new_lines, str):
+            new_lines = new_lines.split("\n")
+        if kind == "replace":
+            replaced[idx] = [str(l) for l in new_lines]
+        elif kind == "insert_after":
+            inserted.setdefault(idx, []).extend(str(l) for l in new_lines)
+        elif kind == "delete":
+            deleted.add(idx)
+        else:
+            raise ValueError(f"Invalid patch operation: {kind!r}")
+
+    merged = []
+    for idx, line in enumerate(lines):
+        if idx in replaced:
+            merged.extend(replaced[idx])
+        elif idx not in deleted:
+            merged.append(line)
+        merged.extend(inserted.get(idx, []))
+    return merged
+
+def section_diff(old: str, new: str) -> str:
+    return "\n".join(difflib.unified_diff(
+        old.split("\n"), new.split("\n"), fromfile="current", tofile="revised", lineterm=""
+    ))
+
+async def update_section_incremental(data: UpdateRequest, user: str):
+    lines = data.currentContent.split("\n")
+    window = select_patch_window(lines, data.remark)
+
+    if window is not None:
+        excerpt = "\n".join(f"L{i}: {lines[i]}" for i in window)
+        prompt = f"""You are editing part of the '{data.section}' Design Input section for the medical device '{data.deviceName}', intended for '{data.intendedUse}'.
+
+Below are the only lines of the section relevant to the user remark, each prefixed with its anchor (L<n>). Lines not shown must stay unchanged.
+
+User Remark:
+{data.remark}
+
+Relevant Lines:
+{excerpt}
+
+Return a JSON object of the form {{"ops": [...]}} where each op is one of:
+- {{"op": "replace", "anchor": "L<n>", "lines": ["new line", ...]}}
+- {{"op": "insert_after", "anchor": "L<n>", "lines": ["new line", ...]}}
+- {{"op": "delete", "anchor": "L<n>"}}
+Use only the anchors shown above, keep markdown table rows in the same column layout, and make the smallest change that satisfies the remark.
+"""
+        try:
+            def valid_patch(text):
+                try:
+                    apply_section_patch(lines, json.loads(text).get("ops", []), set(window))
+                    return True
+                except (ValueError, AttributeError):
+                    return False
+
+            response = await routed_completion(
+                "update-section-patch", prompt, section=data.section, validate=valid_patch, user=user,
+                temperature=0.2, response_format={"type": "json_object"},
+            )
+            patch = json.loads(response.choices[0].message.content)
+            ops = patch.get("ops", []) if isinstance(patch, dict) else []
+            merged = "\n".join(apply_section_patch(lines, ops, set(window)))
+            return {
+                "result": merged,
+                "diff": section_diff(data.currentContent, merged),
+                "ops": ops,
+                "mode": "incremental",
+                "usage": response.get("usage", {}),
+            }
+        except Exception as e:
+            print(f"Incremental update failed for {data.section}, rewriting full section: {str(e)}")
+
+    # Remark could not be localised or the patch was unusable
+    prompt = update_prompt(data)
     try:
-        response = await openai.ChatCompletion.acreate(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3
-        )
-        return {"result": response.choices[0].message.content.strip()}
+        response = await routed_completion("update-section", prompt, section=data.section, user=user, temperature=0.3)
+        merged = response.choices[0].message.content.strip()
+        return {
+            "result": merged,
+            "diff": section_diff(data.currentContent, merged),
+            "mode": "full",
+            "usage": response.get("usage", {}),
+        }
     except Exception as e:
         return {"error": str(e)}
 
 @app.post("/extract-options")
-async def extract_options(payload: dict):
+async def extract_options(payload: dict, request: Request):
+    user = request_user(request)
     device_name = payload.get("deviceName", "")
     intended_use = payload.get("intendedUse", "")
     sections = payload.get("sections", [])
     html = payload.get("designInputHtml", "")
 
+    with startup_phase("import bs4"):
+        from bs4 import BeautifulSoup
     soup = BeautifulSoup(html, "html.parser")
     parsed = {}
 
-    # Knowledge base linking standards to their meanings
-    STANDARD_MEANINGS = {
-        # Sterilization
-        "ISO 11135": "Ethylene Oxide Sterilization",
-        "ISO 11137": "Gamma Radiation Sterilization",
-        "AAMI TIR28": "EO Sterilization Validation",
-        "ISO 17665": "Steam Sterilization",
-        # Biocompatibility
-        "ISO 10993-5": "Cytotoxicity Testing",
-        "ISO 10993-10": "Skin Sensitization Testing",
-        "ISO 10993-23": "Irritation Testing",
-        "USP <87>": "In Vitro Cytotoxicity",
-        "USP <88>": "In Vivo Biocompatibility",
-        # Packaging
-        "ISO 11607": "Packaging Validation",
-        "ASTM D4169": "Distribution Simulation Testing",
-        # Labeling
-        "EN ISO 15223-1": "Medical Device Symbols",
-        "21 CFR Part 801": "US Labeling Requirements",
-        # Quality Systems
-        "ISO 13485": "Quality Management System",
-        "21 CFR Part 820": "US FDA QSR"
-    }
-
     SECTION_PROMPTS = {
         "Sterilization Requirements": """
         Analyze the sterilization content and return consolidated options that combine:
@@ -956,62 +2757,135 @@ async def extract_options(payload: dict):
         # ... (similar consolidated prompts for other sections)
     }
 
-    for section in sections:
-        parsed[section] = []
-        normalized = section.replace(" ", "").replace("/", "").replace("-", "")
-        
-        # Extract section content (same as before)
-        section_div = soup.find("div", {"id": f"section-block-{normalized}"})
-        if not section_div:
-            header = soup.find(["h2", "h3"], string=lambda text: section.lower() in text.lower() if text else False)
-            section_div = header.find_parent("div") if header else None
-
-        if section_div:
-            content_div = section_div.find("div", {"id": f"result-{normalized}"}) or \
-                         section_div.find("div", class_=lambda x: x and "results" in x.lower()) or \
-                         section_div
-            text = content_div.get_text(separator="\n", strip=True)
-
-            if section in SECTION_PROMPTS:
-                try:
-                    prompt = f"""Device: {device_name}
-                    Intended Use: {intended_use}
-                    Section: {section}
+    # Sections already extracted are cached if the client leaves mid-way
+    completed = []
+
+    def keep_completed():
+        cache_completed("extract-options", completed)
+
+    with llm_scheduler.admission("interactive"):
+        for section in sections:
+            parsed[section] = []
+            text = find_section_text(soup, section)
+
+            if text is not None:
+                if section in SECTION_PROMPTS:
+                    try:
+                        prompt = f"""Device: {device_name}
+                        Intended Use: {intended_use}
+                        Section: {section}
                     
-                    {SECTION_PROMPTS[section]}
+                        {SECTION_PROMPTS[section]}
                     
-                    Content to analyze:
-                    {text}
-                    """
+                        Content to analyze:
+                        {text}
+                        """
                     
-                    response = await openai.ChatCompletion.acreate(
-                        model="gpt-4o",
-                        messages=[{"role": "user", "content": prompt}],
-                        temperature=0.2,  # Lower temp for more consistent linking
-                        max_tokens=600
-                    )
+                        raw_options = claim_cached_completion("extract-options", prompt)
+                        if raw_options is None:
+                            response = await unless_disconnected(
+                                request,
+                                routed_completion(
+                                    "extract-options", prompt, section=section, user=user,
+                                    temperature=0.2,  # Lower temp for more consistent linking
+                                    max_tokens=600
+                                ),
+                                "extract-options",
+                                keep_completed,
+                            )
+                            raw_options = response.choices[0].message.content.strip()
+                            completed.append((section, prompt, raw_options, response.get("model", "")))
                     
-                    # Post-process to ensure standards are properly linked
-                    raw_options = response.choices[0].message.content.strip()
-                    options = []
+                        # Post-process to ensure standards are properly linked
+                        options = []
                     
-                    for line in raw_options.split("\n"):
-                        if line.strip().startswith("-"):
-                            option = line.strip("- ").strip()
-                            # Enhance with standard meanings where applicable
-                            for std, meaning in STANDARD_MEANINGS.items():
-                                if std in option and meaning not in option:
-                                    option = option.replace(std, f"{meaning} ({std})")
-                            options.append(option)
+                        for line in raw_options.split("\n"):
+                            if line.strip().startswith("-"):
+                                option = line.strip("- ").strip()
+                                # Enhance with standard meanings where applicable
+                                for std, meaning in STANDARD_MEANINGS.items():
+                                    if std in option and meaning not in option:
+                                        option = option.replace(std, f"{meaning} ({std})")
+                                options.append(option)
                     
-                    parsed[section] = sorted(list(set(options)))
+                        parsed[section] = sorted(list(set(options)))
                     
-                except Exception as e:
-                    print(f"Error processing {section}: {str(e)}")
-                    parsed[section] = []
+                    except HTTPException:
+                        raise
+                    except Exception as e:
+                        print(f"Error processing {section}: {str(e)}")
+                        parsed[section] = []
 
-    return {"parsed": parsed}
+    return FastJSONResponse({"parsed": parsed})
 
 @app.get("/")
 async def root():
     return {"message": "Backend is awake!"}
+
+# --- Metrics ---
+# Counters are kept in the shared store so every worker reports the same totals.
+# Increments are collected in memory and written in one transaction every
+# METRICS_FLUSH_SECONDS, so recording a metric never waits on the store's lock
+# and a failed write cannot fail the request that recorded it.
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+_pending_metrics = Counter()
+_metrics_flusher = None
+
+def record_metric(name: str, value: float = 1, **labels):
+    global _metrics_flusher
+    _pending_metrics[(name, json.dumps(labels, sort_keys=True))] += value
+    if _metrics_flusher is None or _metrics_flusher.done():
+        try:
+            _metrics_flusher = asyncio.get_running_loop().create_task(metrics_flusher())
+        except RuntimeError:
+            pass  # No event loop yet; the next call starts the flusher
+
+def flush_metrics():
+    """Write pending increments; if the write fails they stay pending."""
+    if not _pending_metrics:
+        return
+    pending = dict(_pending_metrics)
+    _pending_metrics.clear()
+    try:
+        with store_transaction() as conn:
+            conn.executemany(
+                """INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?)
+                   ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value""",
+                [(name, key, value) for (name, key), value in pending.items()],
+            )
+    except sqlite3.Error as e:
+        _pending_metrics.update(pending)
+        print(f"Could not flush metrics: {str(e)}")
+
+async def metrics_flusher():
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_SECONDS)
+        flush_metrics()
+
+@app.on_event("shutdown")
+async def flush_metrics_on_shutdown():
+    flush_metrics()
+
+@app.get("/metrics")
+async def get_metrics():
+    flush_metrics()
+    rows = store().execute("SELECT name, labels, value FROM metrics ORDER BY name, labels").fetchall()
+    return {
+        "metrics": [
+            {"name": name, "labels": json.loads(labels), "value": round(value, 2)} for name, labels, value in rows
+        ],
+        "schedulers": {
+            "llm": llm_scheduler.snapshot(),
+            "render": render_scheduler.snapshot(),
+        },
+    }
+
+@app.get("/startup-timings")
+async def startup_timings():
+    return {
+        "mode": STARTUP_MODE,
+        "uptimeMs": round((time.perf_counter() - MODULE_STARTED) * 1000, 2),
+        "phases": STARTUP_TIMINGS,
+    }
+
+APP_IMPORTED = time.perf_counter()